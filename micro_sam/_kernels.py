@@ -0,0 +1,281 @@
+"""Kernels for performance critical operations on label arrays.
+
+The kernels are implemented with numba if it is available. Numba is an optional dependency,
+so we also provide implementations based on numpy that are used if numba is not installed.
+The numba kernels are parallelized, so code that already runs in several threads should use 'serial'
+to switch to the numpy implementations. Otherwise the threads would oversubscribe the cores,
+or fail with concurrent access errors for numba's workqueue threading layer.
+"""
+
+import threading
+from contextlib import contextmanager
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except (ImportError, SystemError):
+    HAVE_NUMBA = False
+
+
+_thread_state = threading.local()
+
+
+@contextmanager
+def serial():
+    """Use the numpy implementations of the kernels in the current thread, e.g. in a worker thread of a pool."""
+    previous = getattr(_thread_state, "serial", False)
+    _thread_state.serial = True
+    try:
+        yield
+    finally:
+        _thread_state.serial = previous
+
+
+def _is_contiguous(*arrays):
+    return all(isinstance(arr, np.ndarray) and arr.flags.c_contiguous for arr in arrays)
+
+
+def _use_numba(*arrays):
+    return HAVE_NUMBA and not getattr(_thread_state, "serial", False) and _is_contiguous(*arrays)
+
+
+if HAVE_NUMBA:
+
+    @njit(parallel=True, cache=True)
+    def _label_max_numba(labels):
+        max_id = labels[0]
+        for i in prange(labels.size):
+            max_id = max(max_id, labels[i])
+        return max_id
+
+    @njit(parallel=True, cache=True)
+    def _commit_labels_numba(seg, committed, id_offset, preserve_committed, mask):
+        for i in prange(seg.size):
+            val = seg[i]
+            if val == 0 or (preserve_committed and committed[i] != 0):
+                mask[i] = False
+                continue
+            val += id_offset
+            seg[i] = val
+            committed[i] = val
+            mask[i] = True
+
+    @njit(parallel=True, cache=True)
+    def _add_offset_nonzero_numba(labels, offset):
+        # Starting from the first value is fine here, because the offset never decreases it.
+        max_id = labels[0]
+        for i in prange(labels.size):
+            val = labels[i]
+            if val != 0:
+                val += offset
+                labels[i] = val
+            max_id = max(max_id, val)
+        return max_id
+
+    @njit(parallel=True, cache=True)
+    def _replace_object_numba(labels, seg, object_id):
+        for i in prange(labels.size):
+            if seg[i] == 1:
+                labels[i] = object_id
+            elif labels[i] == object_id:
+                labels[i] = 0
+
+    @njit(parallel=True, cache=True)
+    def _label_range_numba(labels):
+        min_id, max_id = labels[0], labels[0]
+        for i in prange(labels.size):
+            min_id = min(min_id, labels[i])
+            max_id = max(max_id, labels[i])
+        return min_id, max_id
+
+
+def label_max(labels: np.ndarray, block_shape: Optional[Tuple[int, ...]] = None) -> int:
+    """Compute the maximum value of a label array.
+
+    Args:
+        labels: The label array. Can also be a chunked array, e.g. a zarr array.
+        block_shape: The block shape for computing the maximum of a chunked array.
+            By default the chunks of the array are used.
+
+    Returns:
+        The maximum label id.
+    """
+    if labels.size == 0:
+        return 0
+    if not isinstance(labels, np.ndarray):
+        # Chunked arrays (e.g. zarr arrays) don't implement max, so we compute it block-wise.
+        from elf.parallel import max as parallel_max
+
+        block_shape = labels.chunks if block_shape is None else block_shape
+        return int(parallel_max(labels, block_shape=block_shape))
+    if _use_numba(labels):
+        return int(_label_max_numba(labels.reshape(-1)))
+    return int(labels.max())
+
+
+def add_offset_nonzero(labels: np.ndarray, offset: int) -> int:
+    """Add an id offset to the non-zero values of a label array and compute the new maximum.
+
+    The label array is updated in-place. This fuses the following numpy operations:
+    ```python
+    max_id = labels.max()
+    labels[labels != 0] += offset
+    max_id = max_id + offset if max_id > 0 else 0
+    ```
+
+    Args:
+        labels: The label array.
+        offset: The offset that is added to the non-zero label ids.
+
+    Returns:
+        The maximum label id after adding the offset. Zero if the labels are empty.
+    """
+    if labels.size == 0:
+        return 0
+    if _use_numba(labels):
+        return int(_add_offset_nonzero_numba(labels.reshape(-1), labels.dtype.type(offset)))
+
+    max_id = int(labels.max())
+    if max_id == 0:
+        return 0
+    labels[labels != 0] += offset
+    return max_id + offset
+
+
+def commit_labels(
+    seg: np.ndarray, committed: np.ndarray, id_offset: int, preserve_committed: bool
+) -> np.ndarray:
+    """Add an id offset to a segmentation and write it to the committed objects in a single pass.
+
+    Both 'seg' and 'committed' are updated in-place. This fuses the following numpy operations:
+    ```python
+    mask = seg != 0
+    if preserve_committed:
+        mask[committed != 0] = 0
+    seg[mask] += id_offset
+    committed[mask] = seg[mask]
+    ```
+
+    Args:
+        seg: The segmentation to commit.
+        committed: The committed objects, must have the same shape as the segmentation.
+        id_offset: The offset that is added to the segmentation ids.
+        preserve_committed: Whether to preserve already committed objects.
+
+    Returns:
+        The mask of pixels that were committed.
+    """
+    assert seg.shape == committed.shape, f"{seg.shape}, {committed.shape}"
+    if _use_numba(seg, committed):
+        mask = np.empty(seg.shape, dtype="bool")
+        _commit_labels_numba(
+            seg.reshape(-1), committed.reshape(-1), seg.dtype.type(id_offset), preserve_committed, mask.reshape(-1)
+        )
+        return mask
+
+    mask = seg != 0
+    if preserve_committed:
+        mask[committed != 0] = 0
+    seg[mask] += id_offset
+    committed[mask] = seg[mask]
+    return mask
+
+
+def _label_range(labels):
+    if _use_numba(labels):
+        min_id, max_id = _label_range_numba(labels.reshape(-1))
+        return int(min_id), int(max_id)
+    return int(labels.min()), int(labels.max())
+
+
+def unique_labels(
+    labels: np.ndarray, max_range: int = 1 << 20, return_counts: bool = False
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """Compute the sorted unique values of a label array.
+
+    If the label ids span a range smaller than 'max_range' we count them with 'np.bincount',
+    which is much faster than 'np.unique' because it does not need to sort the data.
+
+    Args:
+        labels: The label array.
+        max_range: The maximal range of label ids for which 'np.bincount' is used.
+        return_counts: Whether to also return the number of occurrences of each label id.
+
+    Returns:
+        The unique label ids.
+        The number of occurences of the label ids, only returned if 'return_counts' is True.
+    """
+    if labels.size == 0:
+        return np.unique(labels, return_counts=return_counts)
+    min_id, max_id = _label_range(labels)
+    if max_id - min_id >= max_range:
+        return np.unique(labels, return_counts=return_counts)
+    # We subtract the min id, so that this also works for large ids in a small range, e.g. after an id offset.
+    counts = np.bincount((labels - labels.dtype.type(min_id)).ravel().astype("int64"), minlength=1)
+    ids = np.flatnonzero(counts)
+    unique_ids = (ids + min_id).astype(labels.dtype)
+    if return_counts:
+        return unique_ids, counts[ids]
+    return unique_ids
+
+
+def replace_object(labels: np.ndarray, seg: np.ndarray, object_id: int) -> None:
+    """Replace the mask of an object in a label array with a new segmentation in a single pass.
+
+    The label array is updated in-place. This fuses the following numpy operations:
+    ```python
+    labels[labels == object_id] = 0
+    labels[seg == 1] = object_id
+    ```
+
+    Args:
+        labels: The label array.
+        seg: The new segmentation for the object, must have the same shape as the labels.
+        object_id: The id of the object.
+    """
+    assert labels.shape == seg.shape, f"{labels.shape}, {seg.shape}"
+    if _use_numba(labels, seg):
+        _replace_object_numba(labels.reshape(-1), seg.reshape(-1), labels.dtype.type(object_id))
+        return
+
+    labels[labels == object_id] = 0
+    labels[seg == 1] = object_id
+
+
+def _mask_bounding_box(mask):
+    bb = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(ax for ax in range(mask.ndim) if ax != axis)
+        coords = np.flatnonzero(mask.any(axis=other_axes))
+        if coords.size == 0:
+            return None
+        bb.append(slice(coords[0], coords[-1] + 1))
+    return tuple(bb)
+
+
+def paint_masks(labels: np.ndarray, masks: Sequence[np.ndarray], seg_ids: Sequence[int]) -> None:
+    """Paint binary masks into a label array, later masks overwrite earlier ones.
+
+    The label array is updated in-place. This is equivalent to the following numpy loop:
+    ```python
+    for mask, seg_id in zip(masks, seg_ids):
+        labels[mask] = seg_id
+    ```
+    But each mask is only painted within its bounding box, which is much cheaper for small objects.
+
+    Args:
+        labels: The label array.
+        masks: The binary masks, must have the same shape as the labels.
+        seg_ids: The id for each of the masks.
+    """
+    assert len(masks) == len(seg_ids), f"{len(masks)}, {len(seg_ids)}"
+    for mask, seg_id in zip(masks, seg_ids):
+        mask = np.asarray(mask, dtype="bool")
+        assert mask.shape == labels.shape, f"{mask.shape}, {labels.shape}"
+        bb = _mask_bounding_box(mask)
+        if bb is None:
+            continue
+        labels[bb][mask[bb]] = seg_id
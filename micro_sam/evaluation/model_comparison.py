@@ -56,8 +56,8 @@ def _predict_models_with_loader(loader, n_samples, prompt_generator, predictor1,
         with h5py.File(out_path, "a") as f:
             f.create_dataset("image", data=im, compression="gzip")
 
-        gt_ids = np.unique(gt)[1:]
         centers, boxes = util.get_centers_and_bounding_boxes(gt)
+        gt_ids = np.array(list(boxes.keys()), dtype="int64")
         centers = [centers[gt_id] for gt_id in gt_ids]
         boxes = [boxes[gt_id] for gt_id in gt_ids]
 
@@ -7,6 +7,7 @@ from itertools import product
 from typing import Union, Tuple, Optional, List, Dict
 
 import imageio.v3 as imageio
+from skimage.measure import regionprops
 
 import torch
 
@@ -104,28 +105,30 @@ def segment_slices_from_ground_truth(
         predictor=predictor, input_=volume, save_path=embedding_path, ndim=3, verbose=verbose,
     )
 
-    # Compute instance ids (without the background)
-    label_ids = np.unique(ground_truth)[1:]
-    assert len(label_ids) > 0, "There are no objects to perform volumetric segmentation."
+    # Compute the instances (without the background), including their bounding boxes.
+    # We use the bounding boxes to avoid processing the full volume for every object.
+    props = regionprops(ground_truth)
+    assert len(props) > 0, "There are no objects to perform volumetric segmentation."
 
     # Create an empty volume to store incoming segmentations
     final_segmentation = np.zeros_like(ground_truth)
+    # And volumes for the segmentation of the current objects, which are reused for all objects.
+    # We need two of them, because the next object is segmented while the current one is written.
+    output_segs = [np.zeros_like(ground_truth), np.zeros_like(ground_truth)]
 
-    skipped_label_ids = []
-    for label_id in label_ids:
-        # Binary label volume per instance (also referred to as object)
-        this_seg = (ground_truth == label_id).astype("int")
+    def segment_object(object_index):
+        prop = props[object_index]
+        label_id = prop.label
+        output_seg = output_segs[object_index % 2]
 
         # Let's search the slices where we have the current object
-        slice_range = np.where(this_seg)[0]
+        slice_range = (prop.bbox[0], prop.bbox[3] - 1)
 
         # Choose the middle slice of the current object for prompt-based segmentation
-        slice_range = (slice_range.min(), slice_range.max())
         slice_choice = floor(np.mean(slice_range))
-        this_slice_seg = this_seg[slice_choice]
+        this_slice_seg = (ground_truth[slice_choice] == label_id).astype("int")
         if min_size > 0 and this_slice_seg.sum() < min_size:
-            skipped_label_ids.append(label_id)
-            continue
+            return label_id, None
 
         if verbose:
             print(f"The object with id {label_id} lies in slice range: {slice_range}")
@@ -164,11 +167,11 @@ def segment_slices_from_ground_truth(
             point_labels=point_labels.numpy() if isinstance(point_labels, torch.Tensor) else point_labels,
             verbose_embeddings=verbose,
         )
-        output_seg = np.zeros_like(ground_truth)
         output_seg[slice_choice][output_slice == 1] = 1
 
         # Segment the object in the entire volume with the specified segmented slice
-        this_seg, _ = segment_mask_in_volume(
+        # The object is segmented in-place in 'output_seg'.
+        _, (z_min, z_max) = segment_mask_in_volume(
             segmentation=output_seg,
             predictor=predictor,
             image_embeddings=embeddings,
@@ -180,8 +183,22 @@ def segment_slices_from_ground_truth(
             verbose=verbose,
         )
 
-        # Store the entire segmented object
-        final_segmentation[this_seg == 1] = label_id
+        return label_id, np.s_[z_min:(z_max + 1)]
+
+    # The objects are segmented one after the other in a background thread, because the predictor is stateful.
+    # This overlaps writing the current object to the segmentation with the segmentation of the next object.
+    skipped_label_ids = []
+    results = util._prefetch(segment_object, len(props))
+    for object_index, (label_id, z_roi) in enumerate(results):
+        if z_roi is None:
+            skipped_label_ids.append(label_id)
+            continue
+
+        # Store the entire segmented object. Only the slices in the range [z_min, z_max] are segmented,
+        # so we only need to write them and then reset them in the segmentation for the current object.
+        output_seg = output_segs[object_index % 2]
+        np.putmask(final_segmentation[z_roi], output_seg[z_roi] == 1, label_id)
+        output_seg[z_roi] = 0
 
     # Save the volumetric segmentation
     if save_path is not None:
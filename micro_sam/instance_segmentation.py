@@ -26,7 +26,7 @@ from nifty.tools import blocking
 import segment_anything.utils.amg as amg_utils
 from segment_anything.predictor import SamPredictor
 
-from . import util
+from . import _kernels, util
 from ._vendored import batched_mask_to_box, mask_to_rle_pytorch
 
 #
@@ -73,7 +73,9 @@ def mask_data_to_segmentation(
     def require_numpy(mask):
         return mask.cpu().numpy() if torch.is_tensor(mask) else mask
 
+    # Filter the masks and assign their ids first, then paint them in order of decreasing area.
     seg_id = 1
+    object_masks, seg_ids = [], []
     for mask in masks:
         if mask["area"] < min_object_size:
             continue
@@ -81,12 +83,14 @@ def mask_data_to_segmentation(
             continue
 
         this_seg_id = mask.get("seg_id", seg_id)
-        segmentation[require_numpy(mask["segmentation"])] = this_seg_id
+        object_masks.append(require_numpy(mask["segmentation"]))
+        seg_ids.append(this_seg_id)
         seg_id = this_seg_id + 1
+    _kernels.paint_masks(segmentation, object_masks, seg_ids)
 
     if label_masks:
         segmentation = label(segmentation)
-    seg_ids, sizes = np.unique(segmentation, return_counts=True)
+    seg_ids, sizes = _kernels.unique_labels(segmentation, return_counts=True)
 
     # In some cases objects may be smaller than peviously calculated,
     # since they are covered by other objects. We ensure these also get
@@ -952,10 +956,17 @@ class InstanceSegmentationWithDecoder:
             d = bbox[3] - y0
             return [x0, w, y0, h, z0, d]
 
+        # Build the object masks from the bounding box crops of the regionprops,
+        # so that we don't need to compare the full segmentation for each object.
+        def to_mask(prop):
+            mask = np.zeros(shape, dtype="bool")
+            mask[prop.slice] = prop.image
+            return mask
+
         to_bbox = to_bbox_2d if ndim == 2 else to_bbox_3d
         masks = [
             {
-                "segmentation": segmentation == prop.label,
+                "segmentation": to_mask(prop),
                 "area": prop.area,
                 "bbox": to_bbox(prop.bbox),
                 "crop_box": crop_box,
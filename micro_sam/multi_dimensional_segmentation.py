@@ -22,7 +22,7 @@ try:
 except ImportError:
     from tqdm import tqdm
 
-from . import util
+from . import _kernels, util
 from .prompt_based_segmentation import segment_from_mask
 from .instance_segmentation import AMGBase, mask_data_to_segmentation
 
@@ -222,7 +222,8 @@ def _preprocess_closing(slice_segmentation, gap_closing, pbar_update):
     structuring_element[:, 0, 0] = 1
     closed_segmentation = binary_closing(binarized, iterations=gap_closing, structure=structuring_element)
 
-    new_segmentation = np.zeros_like(slice_segmentation)
+    # Every slice is written below, so we don't need to zero-initialize the new segmentation.
+    new_segmentation = np.empty_like(slice_segmentation)
     n_slices = new_segmentation.shape[0]
 
     def process_slice(z, offset):
@@ -413,11 +414,11 @@ def automatic_3d_segmentation(
             continue
         else:
             seg = mask_data_to_segmentation(seg, with_background=with_background, min_object_size=min_object_size)
-            max_z = seg.max()
+            # Add the offset to the non-zero ids and get the new max id in a single pass.
+            max_z = _kernels.add_offset_nonzero(seg, offset)
             if max_z == 0:
                 continue
-            seg[seg != 0] += offset
-            offset = max_z + offset
+            offset = max_z
         segmentation[i] = seg
 
     segmentation = merge_instance_segmentation_3d(
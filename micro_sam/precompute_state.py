@@ -9,11 +9,14 @@ from functools import partial
 from typing import Optional, Tuple, Union, List
 
 import h5py
+import zarr
 import numpy as np
+from numcodecs import Blosc
 
 import torch
 import torch.nn as nn
 
+import segment_anything.utils.amg as amg_utils
 from segment_anything.predictor import SamPredictor
 
 try:
@@ -24,6 +27,24 @@ except ImportError:
 from . import instance_segmentation, util
 
 
+def _write_amg_state(path, amg_state):
+    # Put all state onto the cpu so that the state can be deserialized without a gpu.
+    # We copy the mask data instead of moving it in-place, so that the state that is in use is not changed.
+    crop_list = [
+        amg_utils.MaskData(**{k: v.cpu() if torch.is_tensor(v) else v for k, v in mask_data.items()})
+        for mask_data in amg_state["crop_list"]
+    ]
+    amg_state = {**amg_state, "crop_list": crop_list}
+    # The highest protocol serializes the large arrays and tensors in the state more efficiently.
+    with open(path, "wb") as f:
+        pickle.dump(amg_state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_amg_state(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
 def cache_amg_state(
     predictor: SamPredictor,
     raw: np.ndarray,
@@ -61,30 +82,101 @@ def cache_amg_state(
     if os.path.exists(save_path_amg):
         if verbose:
             print("Load the AMG state from", save_path_amg)
-        with open(save_path_amg, "rb") as f:
-            amg_state = pickle.load(f)
-        amg.set_state(amg_state)
+        amg.set_state(_read_amg_state(save_path_amg))
         return amg
 
     if verbose:
         print("Precomputing the state for instance segmentation.")
 
     amg.initialize(raw if i is None else raw[i], image_embeddings=image_embeddings, verbose=verbose, i=i)
-    amg_state = amg.get_state()
+    _write_amg_state(save_path_amg, amg.get_state())
 
-    # put all state onto the cpu so that the state can be deserialized without a gpu
-    new_crop_list = []
-    for mask_data in amg_state["crop_list"]:
-        for k, v in mask_data.items():
-            if torch.is_tensor(v):
-                mask_data[k] = v.cpu()
-        new_crop_list.append(mask_data)
-    amg_state["crop_list"] = new_crop_list
+    return amg
 
-    with open(save_path_amg, "wb") as f:
-        pickle.dump(amg_state, f)
 
-    return amg
+_IS_STATE_KEYS = ("foreground", "boundary_distances", "center_distances")
+# The key of the dataset that marks which slices of a 3d state have been written.
+_IS_STATE_WRITTEN_KEY = "written"
+
+
+def _convert_legacy_is_state(g, legacy_path):
+    # Convert a cache in the previous layout, with one h5 group per slice in 'is_state.h5' (or 'state' for 2d),
+    # to the zarr cache. Groups that were not written completely are skipped. The h5 file is removed afterwards.
+    with h5py.File(legacy_path, "r") as f:
+        for name, state_group in f.items():
+            if any(key not in state_group for key in _IS_STATE_KEYS):
+                continue
+            state = {key: state_group[key][:] for key in _IS_STATE_KEYS}
+            _write_is_state(g, state, i=None if name == "state" else int(name.split("-")[-1]))
+    os.remove(legacy_path)
+
+
+def _get_is_state_cache(save_path):
+    # The instance segmentation state is cached in the 'is_state' group of the embedding container.
+    # For 3d data we store the states for all slices in one dataset per key, with one chunk per slice.
+    g = zarr.open(str(save_path), mode="a").require_group("is_state")
+    legacy_path = os.path.join(save_path, "is_state.h5")
+    if os.path.exists(legacy_path):
+        _convert_legacy_is_state(g, legacy_path)
+    return g
+
+
+def _require_slice_dataset(g, key, i, slice_shape, dtype, **kwargs):
+    # Get the dataset for the per-slice states, and create or grow it so that it contains slice i.
+    shape = (i + 1,) + tuple(slice_shape)
+    if key not in g:
+        return g.create_dataset(key, shape=shape, chunks=(1,) + tuple(slice_shape), dtype=dtype, **kwargs)
+    ds = g[key]
+    if ds.shape[0] <= i:
+        ds.resize(shape)
+    return ds
+
+
+def _write_is_state(g, state, i=None):
+    # We use blosc (zstd with byte-shuffle), which is much faster than gzip for the float predictions.
+    compressor = Blosc(cname="zstd", clevel=3, shuffle=Blosc.SHUFFLE)
+    if i is None:
+        for key in _IS_STATE_KEYS:
+            data = state[key]
+            g.create_dataset(key, data=data, chunks=data.shape, compressor=compressor, overwrite=True)
+        return
+
+    for key in _IS_STATE_KEYS:
+        data = state[key]
+        ds = _require_slice_dataset(g, key, i, data.shape, data.dtype, compressor=compressor)
+        ds[i] = data
+    # We mark the slice as written after all keys are written, so that partially written slices are not read.
+    written = _require_slice_dataset(g, _IS_STATE_WRITTEN_KEY, i, (), "bool", fill_value=False)
+    written[i] = True
+
+
+def _has_is_state(g, i=None):
+    # Check if the state (for slice i) is cached, without reading the full state.
+    if any(key not in g for key in _IS_STATE_KEYS):
+        return False
+    if i is None:
+        return True
+    if _IS_STATE_WRITTEN_KEY not in g:
+        return False
+    written = g[_IS_STATE_WRITTEN_KEY]
+    return i < written.shape[0] and bool(written[i])
+
+
+def _read_is_state(g, i=None):
+    if not _has_is_state(g, i=i):
+        return None
+    if i is None:
+        return {key: g[key][:] for key in _IS_STATE_KEYS}
+    return {key: g[key][i] for key in _IS_STATE_KEYS}
+
+
+def _read_all_is_states(g):
+    # Read the states for all slices that have been written.
+    if any(key not in g for key in _IS_STATE_KEYS + (_IS_STATE_WRITTEN_KEY,)):
+        return {}
+    written = np.flatnonzero(g[_IS_STATE_WRITTEN_KEY][:]).tolist()
+    data = {key: g[key][:] for key in _IS_STATE_KEYS}
+    return {i: {key: val[i] for key, val in data.items()} for i in written}
 
 
 def cache_is_state(
@@ -105,7 +197,7 @@ def cache_is_state(
         decoder: The instance segmentation decoder.
         raw: The image data.
         image_embeddings: The image embeddings.
-        save_path: The embedding save path. The AMG state will be stored in 'save_path/amg_state.pickle'.
+        save_path: The embedding save path. The state will be stored in the group 'is_state' of this zarr file.
         verbose: Whether to run the computation verbose.
         i: The index for which to cache the state.
         skip_load: Skip loading the state if it is precomputed.
@@ -119,36 +211,22 @@ def cache_is_state(
 
     # If i is given we compute the state for a given slice/frame.
     # And we have to save the state for slices/frames separately.
-    save_path = os.path.join(save_path, "is_state.h5")
-    save_key = "state" if i is None else f"state-{i}"
-
-    with h5py.File(save_path, "a") as f:
-        if save_key in f:
-            if skip_load:  # Skip loading to speed this up for cases where we don't need the return val.
-                return
-
-            if verbose:
-                print("Load instance segmentation state from", save_path, ":", save_key)
-            g = f[save_key]
-            state = {
-                "foreground": g["foreground"][:],
-                "boundary_distances": g["boundary_distances"][:],
-                "center_distances": g["center_distances"][:],
-            }
-            amg.set_state(state)
-            return amg
+    g = _get_is_state_cache(save_path)
+    if _has_is_state(g, i=i):
+        if skip_load:  # Skip loading to speed this up for cases where we don't need the return val.
+            return
+
+        if verbose:
+            print("Load instance segmentation state from", save_path, "" if i is None else f": slice {i}")
+        amg.set_state(_read_is_state(g, i=i))
+        return amg
 
     if verbose:
         print("Precomputing the state for instance segmentation.")
 
     amg.initialize(raw, image_embeddings=image_embeddings, verbose=verbose, i=i)
     state = amg.get_state()
-
-    with h5py.File(save_path, "a") as f:
-        g = f.create_group(save_key)
-        g.create_dataset("foreground", data=state["foreground"], compression="gzip")
-        g.create_dataset("boundary_distances", data=state["boundary_distances"], compression="gzip")
-        g.create_dataset("center_distances", data=state["center_distances"], compression="gzip")
+    _write_is_state(g, state, i=i)
 
     return amg
 
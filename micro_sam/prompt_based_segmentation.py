@@ -259,6 +259,7 @@ def _tile_to_full_mask(mask, shape, tile):
 #
 
 
+@torch.inference_mode()
 def segment_from_points(
     predictor: SamPredictor,
     points: np.ndarray,
@@ -316,6 +317,7 @@ def segment_from_points(
         return mask
 
 
+@torch.inference_mode()
 def segment_from_mask(
     predictor: SamPredictor,
     mask: np.ndarray,
@@ -417,6 +419,7 @@ def segment_from_mask(
         return mask
 
 
+@torch.inference_mode()
 def segment_from_box(
     predictor: SamPredictor,
     box: np.ndarray,
@@ -458,6 +461,7 @@ def segment_from_box(
         return mask
 
 
+@torch.inference_mode()
 def segment_from_box_and_points(
     predictor: SamPredictor,
     box: np.ndarray,
@@ -23,6 +23,9 @@ class _AnnotatorBase(QtWidgets.QScrollArea):
         self._viewer.add_labels(data=dummy_data, name="committed_objects")
         # Randomize colors so it is easy to see when object committed.
         self._viewer.layers["committed_objects"].new_colormap()
+        # Invalidate the cached max id and block shape of the committed objects if they are changed outside of commits.
+        self._viewer.layers["committed_objects"].events.data.connect(self._reset_committed_state)
+        self._viewer.layers["committed_objects"].events.paint.connect(self._reset_committed_state)
 
         # Add the point layer for point prompts.
         self._point_labels = ["positive", "negative"]
@@ -44,6 +47,11 @@ class _AnnotatorBase(QtWidgets.QScrollArea):
             face_color="transparent", edge_color="green", edge_width=4, name="prompts", ndim=self._ndim,
         )
 
+    def _reset_committed_state(self, event=None):
+        state = AnnotatorState()
+        state.committed_id_offset = None
+        state.block_shape = None
+
     # Child classes have to implement this function and create a dictionary with the widgets.
     def _get_widgets(self):
         raise NotImplementedError("The child classes of _AnnotatorBase have to implement _get_widgets.")
@@ -162,6 +170,8 @@ class _AnnotatorBase(QtWidgets.QScrollArea):
             self._shape = state.image_shape
 
         # Reset all layers.
+        # Note: we allocate the label data with np.zeros (and not np.zeros_like, np.empty + fill or a lazy wrapper),
+        # because its memory is only materialized by the OS once it is written to, e.g. when painting or segmenting.
         self._viewer.layers["current_object"].data = np.zeros(self._shape, dtype="uint32")
         self._viewer.layers["auto_segmentation"].data = np.zeros(self._shape, dtype="uint32")
         if segmentation_result is None or segmentation_result is False:
@@ -3,6 +3,9 @@ The singleton is implemented following the metaclass design described here:
 https://itnext.io/deciding-the-best-singleton-approach-in-python-65c61e90cdc4
 """
 
+import queue
+import atexit
+import threading
 from functools import partial
 from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple
@@ -25,6 +28,15 @@ except ImportError:
     from tqdm import tqdm
 
 
+# The maximal number of pending writes to the cache. Submitting more writes blocks until one is finished,
+# so that the states don't pile up in memory if writing is slower than computing them.
+_CACHE_QUEUE_SIZE = 8
+# The errors that are expected when writing to the cache, e.g. if the disk is full or the file is corrupted.
+_CACHE_WRITE_ERRORS = (
+    OSError, zarr.errors.MetadataError, zarr.errors.ContainsArrayError, zarr.errors.ContainsGroupError
+)
+
+
 class Singleton(type):
     _instances = {}
 
@@ -64,6 +76,21 @@ class AnnotatorState(metaclass=Singleton):
     # z-range to limit the data being committed in 3d / tracking.
     z_range: Optional[Tuple[int, int]] = None
 
+    # The max id of the committed objects, which is used as id offset for the next commit.
+    # It is computed on the first commit and then updated by each commit, so that we don't have
+    # to compute the max over the full volume each time. Set to None to recompute it.
+    committed_id_offset: Optional[int] = None
+
+    # The block shape for storing the committed objects. We use the chunks of the committed objects
+    # if they are backed by a chunked array, so that blocks are aligned with the chunks. Set to None to recompute it.
+    block_shape: Optional[Tuple[int, ...]] = None
+
+    # Queue and thread for writing the amg state to the cache in the background,
+    # and the first error that occurred when writing, which is raised by wait_for_cache.
+    cache_queue: Optional[queue.Queue] = None
+    cache_writer: Optional[threading.Thread] = None
+    cache_error: Optional[Exception] = None
+
     def initialize_predictor(
         self,
         image_data,
@@ -150,6 +177,53 @@ class AnnotatorState(metaclass=Singleton):
                         save_path=save_path, i=i, verbose=False,
                     )
 
+    def _write_cache(self):
+        while True:
+            write_function, args, kwargs = self.cache_queue.get()
+            try:
+                write_function(*args, **kwargs)
+            except _CACHE_WRITE_ERRORS as e:
+                # We keep the first error to raise it in wait_for_cache and continue with the next write.
+                if self.cache_error is None:
+                    self.cache_error = e
+            finally:
+                self.cache_queue.task_done()
+
+    def _require_cache_writer(self):
+        # (Re-)start the writer thread if it is not running, e.g. because it stopped due to an unexpected error.
+        # The pending writes stay in the queue, so they are done by the new thread.
+        if self.cache_writer is None or not self.cache_writer.is_alive():
+            self.cache_writer = threading.Thread(target=self._write_cache, daemon=True)
+            self.cache_writer.start()
+
+    def write_to_cache(self, write_function, *args, **kwargs):
+        """Call the write function in a background thread.
+
+        The write functions are called one after the other in the order they were submitted.
+        This blocks if the maximal number of pending writes is reached, until one of them is finished.
+        """
+        if self.cache_queue is None:
+            self.cache_queue = queue.Queue(maxsize=_CACHE_QUEUE_SIZE)
+            # Make sure that all pending writes are finished before exiting.
+            atexit.register(self.wait_for_cache)
+        self._require_cache_writer()
+        self.cache_queue.put((write_function, args, kwargs))
+
+    def wait_for_cache(self):
+        """Wait until all pending writes to the cache are finished.
+
+        Raises:
+            RuntimeError: If one of the writes failed. The original error is attached as the cause.
+        """
+        if self.cache_queue is None:
+            return
+        if self.cache_queue.unfinished_tasks > 0:
+            self._require_cache_writer()
+        self.cache_queue.join()
+        if self.cache_error is not None:
+            error, self.cache_error = self.cache_error, None
+            raise RuntimeError(f"Writing to the cache failed with: {error}") from error
+
     def initialized_for_interactive_segmentation(self):
         have_image_embeddings = self.image_embeddings is not None
         have_predictor = self.predictor is not None
@@ -195,6 +269,7 @@ class AnnotatorState(metaclass=Singleton):
 
     def reset_state(self):
         """Reset state, clear all attributes."""
+        self.wait_for_cache()
         self.image_embeddings = None
         self.predictor = None
         self.image_shape = None
@@ -207,4 +282,6 @@ class AnnotatorState(metaclass=Singleton):
         self.committed_lineages = None
         self.z_range = None
         self.data_signature = None
+        self.committed_id_offset = None
+        self.block_shape = None
         # Note: we don't clear the widgets here, because they are fixed for a viewer session.
@@ -2,25 +2,24 @@
 """
 
 import os
-import pickle
+import threading
+from concurrent import futures
 from pathlib import Path
 from typing import Optional
 import multiprocessing as mp
 
-import h5py
-import json
 import zarr
 import z5py
 import napari
+import nifty
 import numpy as np
 
-import elf.parallel
-
 from qtpy import QtWidgets
 from qtpy.QtCore import QObject, Signal
 from superqt import QCollapsible
 from magicgui import magic_factory
 from magicgui.widgets import ComboBox, Container, create_widget
+from scipy.ndimage import find_objects
 # We have disabled the thread workers for now because they result in a
 # massive slowdown in napari >= 0.5.
 # See also https://forum.image.sc/t/napari-thread-worker-leads-to-massive-slowdown/103786
@@ -30,7 +29,8 @@ from napari.utils import progress
 from ._state import AnnotatorState
 from . import util as vutil
 from ._tooltips import get_tooltip
-from .. import instance_segmentation, util
+from .. import _kernels, instance_segmentation, util
+from ..precompute_state import _get_is_state_cache, _write_amg_state, _write_is_state
 from ..multi_dimensional_segmentation import segment_mask_in_volume, merge_instance_segmentation_3d, PROJECTION_MODES
 
 
@@ -291,12 +291,17 @@ def _reset_tracking_state(viewer):
     state.lineage = {1: []}
 
     # Reset the layer properties.
-    viewer.layers["point_prompts"].property_choices["track_id"] = ["1"]
-    viewer.layers["prompts"].property_choices["track_id"] = ["1"]
+    for prompt_layer in (viewer.layers["point_prompts"], viewer.layers["prompts"]):
+        prompt_layer.property_choices["track_id"] = ["1"]
 
     # Reset the choices in the track_id menu.
-    state.widgets["tracking"][1].value = "1"
-    state.widgets["tracking"][1].choices = ["1"]
+    # We block the change events while updating choices and value, so that the
+    # callbacks that update the prompt layers are triggered only once for the final state.
+    track_id_menu = state.widgets["tracking"][1]
+    with track_id_menu.changed.blocked():
+        track_id_menu.choices = ["1"]
+        track_id_menu.value = "1"
+    track_id_menu.changed.emit("1")
 
 
 #
@@ -345,60 +350,230 @@ def clear_track(viewer: "napari.viewer.Viewer", all_frames: bool = True) -> None
         vutil.clear_annotations_slice(viewer, i=i)
 
 
+# Restrict the bounding box to the objects in data[bb], so that we only process the data around them.
+def _get_object_bounding_box(data, bb):
+    object_slices = [sl for sl in find_objects(data[bb]) if sl is not None]
+    if len(object_slices) == 0:
+        return bb
+    return tuple(
+        slice(outer.start + min(sl[dim].start for sl in object_slices),
+              outer.start + max(sl[dim].stop for sl in object_slices))
+        for dim, outer in enumerate(bb)
+    )
+
+
 def _commit_impl(viewer, layer, preserve_committed):
+    # Look up the layers once, since accessing layers by name is a linear search over the layer list.
+    committed_layer = viewer.layers["committed_objects"]
+    committed_data = committed_layer.data
+    layer_data = viewer.layers[layer].data
+
     # Check if we have a z_range. If yes, use it to set a bounding box.
     state = AnnotatorState()
+    shape = committed_data.shape
     if state.z_range is None:
-        bb = np.s_[:]
+        z_min, z_max = 0, shape[0] - 1
     else:
         z_min, z_max = state.z_range
-        bb = np.s_[z_min:(z_max+1)]
+    bb = (slice(z_min, z_max + 1),) + tuple(slice(0, sh) for sh in shape[1:])
+    bb = _get_object_bounding_box(layer_data, bb)
 
     # Cast the dtype of the segmentation we work with correctly.
     # Otherwise we run into type conversion errors later.
-    dtype = viewer.layers["committed_objects"].data.dtype
-    seg = viewer.layers[layer].data[bb].astype(dtype)
-    shape = seg.shape
+    seg = layer_data[bb].astype(committed_data.dtype)
 
-    # We parallelize these operatios because they take quite long for large volumes.
+    # We use parallel kernels for these operatios because they take quite long for large volumes.
 
-    # Compute the max id in the commited objects.
-    # id_offset = int(viewer.layers["committed_objects"].data.max())
-    full_shape = viewer.layers["committed_objects"].data.shape
-    id_offset = int(
-        elf.parallel.max(viewer.layers["committed_objects"].data, block_shape=util.get_block_shape(full_shape))
-    )
+    # Get the max id in the commited objects. We only compute it if it is not cached yet.
+    if state.committed_id_offset is None:
+        state.committed_id_offset = _kernels.label_max(committed_data, block_shape=_get_block_shape(committed_data))
+    id_offset = state.committed_id_offset
 
-    # Compute the mask for the current object.
+    # Compute the mask for the current object, add the id offset and write it to the committed objects.
+    # This is done in a single pass over the data, which corresponds to:
     # mask = seg != 0
-    mask = np.zeros(seg.shape, dtype="bool")
-    mask = elf.parallel.apply_operation(
-        seg, 0, np.not_equal, out=mask, block_shape=util.get_block_shape(shape)
+    # if preserve_committed:
+    #     mask[committed_objects != 0] = 0
+    # seg[mask] += id_offset
+    # committed_objects[mask] = seg[mask]
+    # The fused kernel needs contiguous data. Indexing a numpy array returns a view, which is only contiguous
+    # if the bounding box is not restricted in y and x, so we copy it to contiguous memory otherwise.
+    committed_view = committed_data[bb]
+    committed = np.ascontiguousarray(committed_view)
+    mask = _kernels.commit_labels(seg, committed, id_offset, preserve_committed)
+    # If we work on a view, the committed objects are already updated in-place. If we work on a copy
+    # (or the committed objects are another array type, e.g. a zarr or dask array) we have to write it back.
+    if committed is not committed_view or not isinstance(committed_data, np.ndarray):
+        committed_data[bb] = committed
+    # Update the cached max id. (This is an upper bound if ids of seg are not committed due to preserve_committed.)
+    state.committed_id_offset = max(id_offset, _kernels.label_max(seg))
+    committed_layer.refresh()
+
+    return id_offset, seg, mask, bb
+
+
+def _write_committed_objects(ds, seg, mask, bb):
+    # Write the committed objects chunk by chunk, so that we only read and write the
+    # chunks that are touched by the mask, and don't need to read chunks that are fully overwritten.
+    shape, chunks = ds.shape, ds.chunks
+    roi_begin = [sl.start for sl in bb]
+    roi_end = [sl.stop for sl in bb]
+
+    blocking = nifty.tools.blocking([0] * len(shape), list(shape), list(chunks))
+
+    def write_block(block_id):
+        block = blocking.getBlock(block_id)
+        block_bb = tuple(
+            slice(max(beg, roi_beg), min(end, roi_end_))
+            for beg, end, roi_beg, roi_end_ in zip(block.begin, block.end, roi_begin, roi_end)
+        )
+        local_bb = tuple(slice(sl.start - beg, sl.stop - beg) for sl, beg in zip(block_bb, roi_begin))
+
+        block_mask = mask[local_bb]
+        if not block_mask.any():
+            return
+
+        if block_mask.all():
+            # If the chunk is fully overwritten we write it directly, which skips reading the chunk.
+            # We only do this for chunks that are not clipped at the border of the dataset;
+            # z5py expects data of the full chunk shape in write_chunk.
+            covers_chunk = all(
+                sl.start == beg and sl.stop == beg + ch for sl, beg, ch in zip(block_bb, block.begin, chunks)
+            )
+            if covers_chunk:
+                chunk_id = tuple(beg // ch for beg, ch in zip(block.begin, chunks))
+                ds.write_chunk(chunk_id, np.ascontiguousarray(seg[local_bb]))
+            else:
+                ds[block_bb] = seg[local_bb]
+        else:
+            data = ds[block_bb]
+            data[block_mask] = seg[local_bb][block_mask]
+            ds[block_bb] = data
+
+    # The chunks are independent from each other, so we can write them in parallel.
+    block_ids = blocking.getBlockIdsOverlappingBoundingBox(roi_begin, roi_end)
+    with futures.ThreadPoolExecutor(mp.cpu_count()) as tp:
+        list(tp.map(write_block, block_ids))
+
+
+def _write_committed_segmentation(f, full_shape, block_shape, seg, mask, bb, id_offset):
+    is_empty = "committed_objects" not in f
+    # We use blosc (lz4 with byte-shuffle) instead of gzip, because it is multi-threaded
+    # and much faster for label data, while achieving a similar compression ratio.
+    ds = f.require_dataset(
+        "committed_objects", shape=full_shape, chunks=block_shape, dtype=seg.dtype,
+        compression="blosc", codec="lz4", clevel=5, shuffle=1,
     )
-    if preserve_committed:
-        prev_seg = viewer.layers["committed_objects"].data[bb]
-        mask[prev_seg != 0] = 0
+    ds.n_threads = mp.cpu_count()
+    # If the dataset was just created and we did not have any committed objects before,
+    # then we can write the segmentation directly. Otherwise we only update the touched chunks.
+    if is_empty and id_offset == 0:
+        ds[bb] = seg
+    else:
+        _write_committed_objects(ds, seg, mask, bb)
 
-    # Write the current object to committed objects.
-    seg[mask] += id_offset
-    viewer.layers["committed_objects"].data[bb][mask] = seg[mask]
-    viewer.layers["committed_objects"].refresh()
 
-    return id_offset, seg, mask, bb
+def _get_block_shape(data):
+    state = AnnotatorState()
+    if state.block_shape is None:
+        # Use the chunks of the data if it is a chunked array (e.g. zarr or dask), otherwise use the default.
+        chunks = getattr(data, "chunksize", getattr(data, "chunks", None))
+        if chunks is not None and len(chunks) == data.ndim and all(isinstance(ch, int) for ch in chunks):
+            state.block_shape = tuple(chunks)
+        else:
+            state.block_shape = util.get_block_shape(data.shape)
+    return state.block_shape
+
+
+_PROMPT_KEYS = ("prompts", "point_prompts")
 
 
-def _commit_to_file(path, viewer, layer, seg, mask, bb, extra_attrs=None):
+def _append_prompts(g, object_ids, prompts, point_prompts):
+    def append(name, data):
+        if name in g:
+            data = np.concatenate([g[name][:], data])
+        g.create_dataset(name, data=data, chunks=False, overwrite=True)
+
+    append("object_ids", np.asarray(object_ids))
+    for name, object_prompts in zip(_PROMPT_KEYS, (prompts, point_prompts)):
+        if object_prompts is None:
+            object_prompts = [[] for _ in object_ids]
+        object_prompts = [np.array(prompt) for prompt in object_prompts]
+
+        offsets_key = f"{name}_offsets"
+        if offsets_key not in g:
+            g.create_dataset(offsets_key, data=np.zeros(1, dtype="int64"), chunks=False)
+        lengths = [len(prompt) for prompt in object_prompts]
+        append(offsets_key, g[offsets_key][-1] + np.cumsum(lengths, dtype="int64"))
+
+        object_prompts = [prompt for prompt in object_prompts if len(prompt) > 0]
+        if len(object_prompts) > 0:
+            append(name, np.concatenate(object_prompts))
+
+
+def _read_legacy_prompts(g):
+    # Previous versions stored the prompts in one group per object: 'prompts/<object_id>/(point_)prompts'.
+    object_ids = sorted(int(key) for key in g.group_keys())
+    prompts = {
+        name: [g[str(object_id)][name][:] if name in g[str(object_id)] else [] for object_id in object_ids]
+        for name in _PROMPT_KEYS
+    }
+    return object_ids, prompts["prompts"], prompts["point_prompts"]
+
+
+def _write_prompts(f, object_ids, prompts, point_prompts):
+    # We store the prompts of all objects in flat datasets, with one chunk per dataset, instead of
+    # one group per object. The (point) prompts of the i-th object in 'object_ids' are given by
+    # prompts[prompts_offsets[i]:prompts_offsets[i+1]] (and the same for 'point_prompts').
+    # Note: we use zarr-python here because z5py does not support overwriting datasets.
+    if len(object_ids) == 0:
+        return
+    g = f.require_group("prompts")
+
+    # Convert the prompts of files written with the previous layout (one group per object) first.
+    legacy_object_ids, legacy_prompts, legacy_point_prompts = _read_legacy_prompts(g)
+    if len(legacy_object_ids) > 0:
+        for object_id in legacy_object_ids:
+            del g[str(object_id)]
+        _append_prompts(g, legacy_object_ids, legacy_prompts, legacy_point_prompts)
+
+    _append_prompts(g, object_ids, prompts, point_prompts)
+
+
+# Read the committed prompts, returns a dictionary that maps object ids to (prompts, point_prompts).
+# The prompts of an object are None if it does not have prompts of the respective type.
+def _read_prompts(f):
+    if "prompts" not in f:
+        return {}
+    g = f["prompts"]
+
+    if "object_ids" not in g:
+        object_ids, prompts, point_prompts = _read_legacy_prompts(g)
+        return {
+            object_id: tuple(prompt if len(prompt) > 0 else None for prompt in object_prompts)
+            for object_id, object_prompts in zip(object_ids, zip(prompts, point_prompts))
+        }
+
+    object_ids = g["object_ids"][:].tolist()
+    object_prompts = {object_id: [None, None] for object_id in object_ids}
+    for j, name in enumerate(_PROMPT_KEYS):
+        if name not in g:
+            continue
+        data, offsets = g[name][:], g[f"{name}_offsets"][:]
+        for object_id, begin, end in zip(object_ids, offsets[:-1], offsets[1:]):
+            if end > begin:
+                object_prompts[object_id][j] = data[begin:end]
+    return {object_id: tuple(prompts) for object_id, prompts in object_prompts.items()}
+
+
+def _commit_to_file(path, viewer, layer, seg, mask, bb, id_offset, extra_attrs=None):
 
     # NOTE: zarr-python is quite inefficient and writes empty blocks.
     # So we have to use z5py here.
 
-    # Deal with issues z5py has with empty folders and require the json.
-    if os.path.exists(path):
-        required_json = os.path.join(path, ".zgroup")
-        if not os.path.exists(required_json):
-            with open(required_json, "w") as f:
-                json.dump({"zarr_format": 2}, f)
-
+    # z5py has issues with empty folders that don't contain the zarr group metadata.
+    # Opening the group with zarr-python first makes sure that the group and its metadata exist.
+    zarr_file = zarr.open_group(str(path), mode="a")
     f = z5py.ZarrFile(path, "a")
 
     # Write metadata about the model that's being used etc.
@@ -418,15 +593,8 @@ def _commit_to_file(path, viewer, layer, seg, mask, bb, extra_attrs=None):
             f.attrs[key] = val
 
     # Write the segmentation.
-    full_shape = viewer.layers["committed_objects"].data.shape
-    block_shape = util.get_block_shape(full_shape)
-    ds = f.require_dataset(
-        "committed_objects", shape=full_shape, chunks=block_shape, compression="gzip", dtype=seg.dtype
-    )
-    ds.n_threads = mp.cpu_count()
-    data = ds[bb]
-    data[mask] = seg[mask]
-    ds[bb] = data
+    committed_data = viewer.layers["committed_objects"].data
+    _write_committed_segmentation(f, committed_data.shape, _get_block_shape(committed_data), seg, mask, bb, id_offset)
 
     # Write additional information to attrs.
     if extra_attrs is not None:
@@ -438,41 +606,30 @@ def _commit_to_file(path, viewer, layer, seg, mask, bb, extra_attrs=None):
         # TODO write the settings for the auto segmentation widget.
         return
 
-    def write_prompts(object_id, prompts, point_prompts):
-        g = f.create_group(f"prompts/{object_id}")
-        if prompts is not None and len(prompts) > 0:
-            data = np.array(prompts)
-            g.create_dataset("prompts", data=data, chunks=data.shape)
-        if point_prompts is not None and len(point_prompts) > 0:
-            g.create_dataset("point_prompts", data=point_prompts, chunks=point_prompts.shape)
-
     # TODO write the settings for the segmentation widget if necessary.
     # Commit the prompts for all the objects in the commit.
-    object_ids = np.unique(seg[mask])
+    object_ids = _kernels.unique_labels(seg[mask])
+    prompt_data, point_prompt_data = viewer.layers["prompts"].data, viewer.layers["point_prompts"].data
     if len(object_ids) == 1:  # We only have a single object.
-        write_prompts(object_ids[0], viewer.layers["prompts"].data, viewer.layers["point_prompts"].data)
+        prompts = [prompt_data]
+        point_prompts = [point_prompt_data]
     else:
         # TODO this logic has to be updated to be compatible with the new batched prompting
-        have_prompts = len(viewer.layers["prompts"].data) > 0
-        have_point_prompts = len(viewer.layers["point_prompts"].data) > 0
+        have_prompts = len(prompt_data) > 0
+        have_point_prompts = len(point_prompt_data) > 0
         if have_prompts and not have_point_prompts:
-            prompts = viewer.layers["prompts"].data
+            prompts = [prompt_data[i:i+1] for i in range(len(object_ids))]
             point_prompts = None
         elif not have_prompts and have_point_prompts:
             prompts = None
-            point_prompts = viewer.layers["point_prompts"].data
+            point_prompts = [point_prompt_data[i:i+1] for i in range(len(object_ids))]
         else:
             msg = "Got multiple objects from interactive segmentation with box and point prompts." if (
                 have_prompts and have_point_prompts
             ) else "Got multiple objects from interactive segmentation with neither box or point prompts."
             raise RuntimeError(msg)
 
-        for i, object_id in enumerate(object_ids):
-            write_prompts(
-                object_id,
-                None if prompts is None else prompts[i:i+1],
-                None if point_prompts is None else point_prompts[i:i+1]
-            )
+    _write_prompts(zarr_file, object_ids, prompts, point_prompts)
 
 
 @magic_factory(
@@ -496,18 +653,19 @@ def commit(
         commit_path: Select a file path where the committed results and prompts will be saved.
             This feature is still experimental.
     """
-    _, seg, mask, bb = _commit_impl(viewer, layer, preserve_committed)
+    id_offset, seg, mask, bb = _commit_impl(viewer, layer, preserve_committed)
 
     if commit_path is not None:
-        _commit_to_file(commit_path, viewer, layer, seg, mask, bb)
+        _commit_to_file(commit_path, viewer, layer, seg, mask, bb, id_offset)
 
     if layer == "current_object":
         vutil.clear_annotations(viewer)
     else:
-        viewer.layers["auto_segmentation"].data = np.zeros(
-            viewer.layers["auto_segmentation"].data.shape, dtype="uint32"
-        )
-        viewer.layers["auto_segmentation"].refresh()
+        # Clear the committed part of the automatic segmentation in-place,
+        # to avoid allocating a new array for the full volume.
+        auto_segmentation_layer = viewer.layers["auto_segmentation"]
+        auto_segmentation_layer.data[bb] = 0
+        auto_segmentation_layer.refresh()
         _select_layer(viewer, "committed_objects")
 
 
@@ -544,7 +702,7 @@ def commit_track(
 
     if commit_path is not None:
         _commit_to_file(
-            commit_path, viewer, layer, seg, mask, bb,
+            commit_path, viewer, layer, seg, mask, bb, id_offset,
             extra_attrs={"committed_lineages": state.committed_lineages}
         )
 
@@ -701,17 +859,18 @@ def segment(viewer: "napari.viewer.Viewer", batched: bool = False) -> None:
     if _validate_prompts(viewer):
         return None
 
-    shape = viewer.layers["current_object"].data.shape
+    # We look up the layer once and get the shape from the state, instead of the layer data.
+    state = AnnotatorState()
+    current_object_layer = viewer.layers["current_object"]
+    shape = state.image_shape
 
     # get the current box and point prompts
     boxes, masks = vutil.shape_layer_to_prompts(viewer.layers["prompts"], shape)
     points, labels = vutil.point_layer_to_prompts(viewer.layers["point_prompts"], with_stop_annotation=False)
 
-    predictor = AnnotatorState().predictor
-    image_embeddings = AnnotatorState().image_embeddings
     seg = vutil.prompt_segmentation(
-        predictor, points, labels, boxes, masks, shape, image_embeddings=image_embeddings,
-        multiple_box_prompts=True, batched=batched, previous_segmentation=viewer.layers["current_object"].data,
+        state.predictor, points, labels, boxes, masks, shape, image_embeddings=state.image_embeddings,
+        multiple_box_prompts=True, batched=batched, previous_segmentation=current_object_layer.data,
     )
 
     # no prompts were given or prompts were invalid, skip segmentation
@@ -719,8 +878,8 @@ def segment(viewer: "napari.viewer.Viewer", batched: bool = False) -> None:
         print("You either haven't provided any prompts or invalid prompts. The segmentation will be skipped.")
         return
 
-    viewer.layers["current_object"].data = seg
-    viewer.layers["current_object"].refresh()
+    # Setting the layer data refreshes the layer, so we don't need to call refresh here.
+    current_object_layer.data = seg
 
 
 @magic_factory(call_button="Segment Slice [S]")
@@ -735,7 +894,8 @@ def segment_slice(viewer: "napari.viewer.Viewer") -> None:
     if _validate_prompts(viewer):
         return None
 
-    shape = viewer.layers["current_object"].data.shape[1:]
+    state = AnnotatorState()
+    shape = state.image_shape[1:]
     position = viewer.cursor.position
     z = int(position[0])
 
@@ -747,7 +907,6 @@ def segment_slice(viewer: "napari.viewer.Viewer") -> None:
     boxes, masks = vutil.shape_layer_to_prompts(viewer.layers["prompts"], shape, i=z)
     points, labels = point_prompts
 
-    state = AnnotatorState()
     seg = vutil.prompt_segmentation(
         state.predictor, points, labels, boxes, masks, shape, multiple_box_prompts=False,
         image_embeddings=state.image_embeddings, i=z,
@@ -758,8 +917,8 @@ def segment_slice(viewer: "napari.viewer.Viewer") -> None:
         print("You either haven't provided any prompts or invalid prompts. The segmentation will be skipped.")
         return
 
-    viewer.layers["current_object"].data[z] = seg
-    viewer.layers["current_object"].refresh()
+    # Only update the changed region of the slice, so that napari does not refresh the full volume.
+    vutil._update_label_object(viewer.layers["current_object"], z, seg, object_id=1)
 
 
 @magic_factory(call_button="Segment Frame [S]")
@@ -796,13 +955,9 @@ def segment_frame(viewer: "napari.viewer.Viewer") -> None:
         print("You either haven't provided any prompts or invalid prompts. The segmentation will be skipped.")
         return
 
-    # clear the old segmentation for this track_id
-    old_mask = viewer.layers["current_object"].data[t] == state.current_track_id
-    viewer.layers["current_object"].data[t][old_mask] = 0
-    # set the new segmentation
-    new_mask = seg.squeeze() == 1
-    viewer.layers["current_object"].data[t][new_mask] = state.current_track_id
-    viewer.layers["current_object"].refresh()
+    # clear the old segmentation for this track_id and set the new segmentation
+    # Only update the changed region of the frame, so that napari does not refresh the full volume.
+    vutil._update_label_object(viewer.layers["current_object"], t, seg.squeeze(), state.current_track_id)
 
 
 #
@@ -1234,13 +1389,10 @@ class SegmentNDWidget(_WidgetBase):
             if has_division and (len(state.lineage[state.current_track_id]) == 0):
                 _update_lineage(self._viewer)
 
-            # Clear the old track mask.
-            self._viewer.layers["current_object"].data[
-                self._viewer.layers["current_object"].data == state.current_track_id
-            ] = 0
-            # Set the new object mask.
-            self._viewer.layers["current_object"].data[seg == 1] = state.current_track_id
-            self._viewer.layers["current_object"].refresh()
+            # Clear the old track mask and set the new object mask.
+            current_object_layer = self._viewer.layers["current_object"]
+            _kernels.replace_object(current_object_layer.data, seg, state.current_track_id)
+            current_object_layer.refresh()
 
         ret_val = tracking_impl()
         update_segmentation(ret_val)
@@ -1282,11 +1434,9 @@ class SegmentNDWidget(_WidgetBase):
 
         def update_segmentation(seg):
             self._viewer.layers["current_object"].data = seg
-            self._viewer.layers["current_object"].refresh()
 
         seg = volumetric_segmentation_impl()
         self._viewer.layers["current_object"].data = seg
-        self._viewer.layers["current_object"].refresh()
         # worker = volumetric_segmentation_impl()
         # worker.returned.connect(update_segmentation)
         # worker.start()
@@ -1309,10 +1459,20 @@ class SegmentNDWidget(_WidgetBase):
 
 
 # Messy amg state handling, would be good to refactor this properly at some point.
+# The amg only needs the image data to compute embeddings, which are passed here, and for its shape.
+# So we pass a read-only view in the RGB uint8 format expected by the amg, which does not allocate any memory.
+def _get_dummy_image(shape):
+    return np.broadcast_to(np.uint8(0), tuple(shape[-2:]) + (3,))
+
+
+def _get_amg(state):
+    is_tiled = state.image_embeddings["input_size"] is None
+    return instance_segmentation.get_amg(state.predictor, is_tiled, decoder=state.decoder)
+
+
 def _handle_amg_state(state, i, pbar_init, pbar_update):
     if state.amg is None:
-        is_tiled = state.image_embeddings["input_size"] is None
-        state.amg = instance_segmentation.get_amg(state.predictor, is_tiled, decoder=state.decoder)
+        state.amg = _get_amg(state)
 
     shape = state.image_shape
 
@@ -1325,7 +1485,7 @@ def _handle_amg_state(state, i, pbar_init, pbar_update):
             state.amg.set_state(amg_state_i)
 
         else:
-            dummy_image = np.zeros(shape[-2:], dtype="uint8")
+            dummy_image = _get_dummy_image(shape)
             state.amg.initialize(
                 dummy_image, image_embeddings=state.image_embeddings, i=i,
                 verbose=pbar_init is not None, pbar_init=pbar_init, pbar_update=pbar_update,
@@ -1333,50 +1493,70 @@ def _handle_amg_state(state, i, pbar_init, pbar_update):
             amg_state_i = state.amg.get_state()
             state.amg_state[i] = amg_state_i
 
+            # Write the state to the cache in the background, so that this does not block the computation.
             cache_folder = state.amg_state.get("cache_folder", None)
             if cache_folder is not None:
-                cache_path = os.path.join(cache_folder, f"state-{i}.pkl")
-                with open(cache_path, "wb") as f:
-                    pickle.dump(amg_state_i, f)
+                state.write_to_cache(_write_amg_state, os.path.join(cache_folder, f"state-{i}.pkl"), amg_state_i)
 
             cache_path = state.amg_state.get("cache_path", None)
             if cache_path is not None:
-                save_key = f"state-{i}"
-                with h5py.File(cache_path, "a") as f:
-                    g = f.create_group(save_key)
-                    g.create_dataset("foreground", data=amg_state_i["foreground"], compression="gzip")
-                    g.create_dataset("boundary_distances", data=amg_state_i["boundary_distances"], compression="gzip")
-                    g.create_dataset("center_distances", data=amg_state_i["center_distances"], compression="gzip")
+                state.write_to_cache(_write_is_state, _get_is_state_cache(cache_path), amg_state_i, i=i)
 
     # Otherwise (2d segmentation) we just check if the amg is initialized or not.
     elif not state.amg.is_initialized:
         assert i is None
         # We don't need to pass the actual image data here, since the embeddings are passed.
         # (The image data is only used by the amg to compute image embeddings, so not needed here.)
-        dummy_image = np.zeros(shape, dtype="uint8")
+        dummy_image = _get_dummy_image(shape)
         state.amg.initialize(
             dummy_image, image_embeddings=state.image_embeddings,
             verbose=pbar_init is not None, pbar_init=pbar_init, pbar_update=pbar_update
         )
 
 
-def _instance_segmentation_impl(with_background, min_object_size, i=None, pbar_init=None, pbar_update=None, **kwargs):
-    state = AnnotatorState()
-    _handle_amg_state(state, i, pbar_init, pbar_update)
-
-    seg = state.amg.generate(**kwargs)
+def _generate_segmentation(amg, shape, with_background, min_object_size, **kwargs):
+    seg = amg.generate(**kwargs)
     if len(seg) == 0:
-        shape = state.image_shape
         seg = np.zeros(shape[-2:], dtype="uint32")
     else:
         seg = instance_segmentation.mask_data_to_segmentation(
             seg, with_background=with_background, min_object_size=min_object_size
         )
     assert isinstance(seg, np.ndarray)
-
     return seg
 
 
+def _instance_segmentation_impl(with_background, min_object_size, i=None, pbar_init=None, pbar_update=None, **kwargs):
+    state = AnnotatorState()
+    _handle_amg_state(state, i, pbar_init, pbar_update)
+    return _generate_segmentation(state.amg, state.image_shape, with_background, min_object_size, **kwargs)
+
+
+# Segment all slices of a volume in parallel. This requires a precomputed amg state for all slices.
+# Each thread uses its own amg instance, because setting the state is not thread-safe.
+# The instances are reused for all slices processed by the same thread, instead of creating one per slice.
+# The kernels run serially in the threads, because the slices are already processed in parallel.
+# A thread pool executor can be passed, otherwise a pool with one thread per core is used.
+def _instance_segmentation_impl_parallel(with_background, min_object_size, n_slices, executor=None, **kwargs):
+    state = AnnotatorState()
+    thread_data = threading.local()
+
+    def segment_slice(i):
+        amg = getattr(thread_data, "amg", None)
+        if amg is None:
+            amg = thread_data.amg = _get_amg(state)
+        amg.set_state(state.amg_state[i])
+        with _kernels.serial():
+            return _generate_segmentation(amg, state.image_shape, with_background, min_object_size, **kwargs)
+
+    if executor is not None:
+        yield from executor.map(segment_slice, range(n_slices))
+        return
+
+    with futures.ThreadPoolExecutor(mp.cpu_count()) as tp:
+        yield from tp.map(segment_slice, range(n_slices))
+
+
 class AutoSegmentWidget(_WidgetBase):
     def __init__(self, viewer, with_decoder, volumetric, parent=None):
         super().__init__(parent)
@@ -1552,11 +1732,14 @@ class AutoSegmentWidget(_WidgetBase):
             if is_empty:
                 self._empty_segmentation_warning()
 
+            # Setting the layer data refreshes the layer. We only need to refresh it after updating it in-place.
+            # (We don't use 'data_setitem' here, because napari would keep each automatic segmentation for undo.)
+            auto_segmentation_layer = self._viewer.layers["auto_segmentation"]
             if i is None:
-                self._viewer.layers["auto_segmentation"].data = seg
+                auto_segmentation_layer.data = seg
             else:
-                self._viewer.layers["auto_segmentation"].data[i] = seg
-            self._viewer.layers["auto_segmentation"].refresh()
+                auto_segmentation_layer.data[i] = seg
+                auto_segmentation_layer.refresh()
 
         seg = seg_impl()
         update_segmentation(seg)
@@ -1573,7 +1756,7 @@ class AutoSegmentWidget(_WidgetBase):
         state = AnnotatorState()
         predictor = state.predictor
         if str(predictor.device) == "cpu" or str(predictor.device) == "mps":
-            n_slices = self._viewer.layers["auto_segmentation"].data.shape[0]
+            n_slices = state.image_shape[0]
             embeddings_are_precomputed = (state.amg_state is not None) and (len(state.amg_state) > n_slices)
             if not embeddings_are_precomputed:
                 return False
@@ -1592,25 +1775,41 @@ class AutoSegmentWidget(_WidgetBase):
 
         # @thread_worker
         def seg_impl():
-            segmentation = np.zeros_like(self._viewer.layers["auto_segmentation"].data)
+            # The slice segmentations are only needed until they are merged, so we don't keep this volume around.
+            # We allocate it with np.zeros (and not np.zeros_like), so that only the pages of the non-empty slices
+            # are materialized by the OS, see also the note in _AnnotatorBase._update_image.
+            state = AnnotatorState()
+            segmentation = np.zeros(state.image_shape, dtype=self._viewer.layers["auto_segmentation"].data.dtype)
             offset = 0
 
             def pbar_init(total, description):
                 pbar_signals.pbar_total.emit(total)
                 pbar_signals.pbar_description.emit(description)
 
-            pbar_init(segmentation.shape[0], "Segment volume")
+            n_slices = segmentation.shape[0]
+            pbar_init(n_slices, "Segment volume")
 
-            # Further optimization: parallelize if state is precomputed for all slices
-            for i in range(segmentation.shape[0]):
-                seg = _instance_segmentation_impl(self.with_background, self.min_object_size, i=i, **kwargs)
-                seg_max = seg.max()
+            # If the state is precomputed for all slices we segment them in parallel.
+            # Otherwise we segment them one after the other, computing the missing states on the fly.
+            if state.amg_state is not None and all(i in state.amg_state for i in range(n_slices)):
+                slice_segmentations = _instance_segmentation_impl_parallel(
+                    self.with_background, self.min_object_size, n_slices, **kwargs
+                )
+            else:
+                slice_segmentations = (
+                    _instance_segmentation_impl(self.with_background, self.min_object_size, i=i, **kwargs)
+                    for i in range(n_slices)
+                )
+
+            # The ids are offset serially, so that they are consecutive across the slices.
+            for i, seg in enumerate(slice_segmentations):
+                pbar_signals.pbar_update.emit(1)
+                # Add the offset to the non-zero ids and get the new max id in a single pass.
+                seg_max = _kernels.add_offset_nonzero(seg, offset)
                 if seg_max == 0:
                     continue
-                seg[seg != 0] += offset
-                offset = seg_max + offset
+                offset = seg_max
                 segmentation[i] = seg
-                pbar_signals.pbar_update.emit(1)
 
             pbar_signals.pbar_reset.emit()
             segmentation = merge_instance_segmentation_3d(
@@ -1627,7 +1826,6 @@ class AutoSegmentWidget(_WidgetBase):
             if is_empty:
                 self._empty_segmentation_warning()
             self._viewer.layers["auto_segmentation"].data = segmentation
-            self._viewer.layers["auto_segmentation"].refresh()
 
         seg = seg_impl()
         update_segmentation(seg)
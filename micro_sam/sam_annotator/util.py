@@ -1,25 +1,27 @@
 import os
-import pickle
 import warnings
 import argparse
 from glob import glob
 from pathlib import Path
 from typing import List, Optional, Tuple
 
-import h5py
 import napari
 import numpy as np
 from skimage import draw
-from scipy.ndimage import shift
+from scipy.ndimage import find_objects, shift
 
-from .. import prompt_based_segmentation, util
+from .. import _kernels, prompt_based_segmentation, util
 from .. import _model_settings as model_settings
 from ..multi_dimensional_segmentation import _validate_projection
+from ..precompute_state import _get_is_state_cache, _read_all_is_states, _read_amg_state
 
 # Green and Red
 LABEL_COLOR_CYCLE = ["#00FF00", "#FF0000"]
 """@private"""
 
+# The number of object predictions that are kept in memory before they are painted into the segmentation.
+_PAINT_BATCH_SIZE = 16
+
 
 #
 # Misc helper functions
@@ -115,8 +117,8 @@ def _initialize_parser(description, with_segmentation_result=True, with_instance
 
 def clear_annotations(viewer: napari.Viewer, clear_segmentations=True) -> None:
     """@private"""
+    # Note: setting the layer data refreshes the layer, so we only call refresh after in-place updates.
     viewer.layers["point_prompts"].data = []
-    viewer.layers["point_prompts"].refresh()
     if "prompts" in viewer.layers:
         # Select all prompts and then remove them.
         # This is how it worked before napari 0.5.
@@ -127,7 +129,6 @@ def clear_annotations(viewer: napari.Viewer, clear_segmentations=True) -> None:
     if not clear_segmentations:
         return
     viewer.layers["current_object"].data = np.zeros(viewer.layers["current_object"].data.shape, dtype="uint32")
-    viewer.layers["current_object"].refresh()
 
 
 def clear_annotations_slice(viewer: napari.Viewer, i: int, clear_segmentations=True) -> None:
@@ -135,18 +136,43 @@ def clear_annotations_slice(viewer: napari.Viewer, i: int, clear_segmentations=T
     point_prompts = viewer.layers["point_prompts"].data
     point_prompts = point_prompts[point_prompts[:, 0] != i]
     viewer.layers["point_prompts"].data = point_prompts
-    viewer.layers["point_prompts"].refresh()
     if "prompts" in viewer.layers:
         prompts = viewer.layers["prompts"].data
         prompts = [prompt for prompt in prompts if not (prompt[:, 0] == i).all()]
         viewer.layers["prompts"].data = prompts
-        viewer.layers["prompts"].refresh()
     if not clear_segmentations:
         return
     viewer.layers["current_object"].data[i] = 0
     viewer.layers["current_object"].refresh()
 
 
+def _update_label_object(layer, i, seg, object_id):
+    # Replace the object 'object_id' in slice (or frame) i of the label layer with the binary segmentation 'seg'.
+    # We write via 'data_setitem', which only updates the changed region of the layer instead of refreshing
+    # the full label volume. napari stores the previous values of the changed pixels for undo, so we only pass
+    # the changed pixels. To find them we only look at the bounding boxes of the old and the new object mask.
+    # This is only used for the interactive segmentation of a single object, where undo (Ctrl+Z) is useful
+    # and the history per edit is bounded by the changed object. Bulk updates, e.g. the automatic
+    # segmentation or clearing a slice, write to the layer data in-place and refresh it instead.
+    labels = layer.data[i]
+    bbs = [_kernels._mask_bounding_box(seg), find_objects(labels, max_label=object_id)[object_id - 1]]
+    bbs = [bb for bb in bbs if bb is not None]
+    if not bbs:
+        return
+    bb = tuple(
+        slice(min(b[axis].start for b in bbs), max(b[axis].stop for b in bbs)) for axis in range(labels.ndim)
+    )
+
+    sub_labels, sub_seg = labels[bb], seg[bb] != 0
+    is_object = sub_labels == object_id
+    changed = np.nonzero(sub_seg != is_object)
+    if changed[0].size == 0:
+        return
+    values = np.where(sub_seg[changed], object_id, 0).astype(labels.dtype)
+    indices = (np.full(changed[0].shape, i),) + tuple(coords + b.start for coords, b in zip(changed, bb))
+    layer.data_setitem(indices, values)
+
+
 #
 # Helper functions to extract prompts from napari layers.
 #
@@ -185,12 +211,12 @@ def point_layer_to_prompts(
 
     if track_id is not None:
         assert i is not None
-        track_ids = np.array(list(map(int, layer.properties["track_id"])))[mask]
+        track_ids = np.asarray(layer.properties["track_id"])[mask].astype("int")
         track_id_mask = track_ids == track_id
         this_labels, this_points = this_labels[track_id_mask], this_points[track_id_mask]
     assert len(this_points) == len(this_labels)
 
-    this_labels = np.array([1 if label == "positive" else 0 for label in this_labels])
+    this_labels = (np.asarray(this_labels) == "positive").astype("int")
     # a single point with a negative label is interpreted as 'stop' signal
     # in this case we return None
     if with_stop_annotation and (len(this_points) == 1 and this_labels[0] == 0):
@@ -262,7 +288,7 @@ def shape_layer_to_prompts(
         if track_id is None:
             prompt_selection = [j for j, data in enumerate(shape_data) if (data[:, 0] == i).all()]
         else:
-            track_ids = np.array(list(map(int, layer.properties["track_id"])))
+            track_ids = np.asarray(layer.properties["track_id"]).astype("int")
             prompt_selection = [
                 j for j, (data, this_track_id) in enumerate(zip(shape_data, track_ids))
                 if ((data[:, 0] == i).all() and this_track_id == track_id)
@@ -360,12 +386,12 @@ def segment_slices_with_prompts(
         np.zeros(0, dtype="int")
 
     if track_id is not None:
-        track_ids_points = np.array(list(map(int, point_prompts.properties["track_id"])))
+        track_ids_points = np.asarray(point_prompts.properties["track_id"]).astype("int")
         assert len(track_ids_points) == len(z_values)
         z_values = z_values[track_ids_points == track_id]
 
         if len(z_values_boxes) > 0:
-            track_ids_boxes = np.array(list(map(int, box_prompts.properties["track_id"])))
+            track_ids_boxes = np.asarray(box_prompts.properties["track_id"]).astype("int")
             assert len(track_ids_boxes) == len(z_values_boxes), f"{len(track_ids_boxes)}, {len(z_values_boxes)}"
             z_values_boxes = z_values_boxes[track_ids_boxes == track_id]
 
@@ -380,14 +406,13 @@ def segment_slices_with_prompts(
         points_i = point_layer_to_prompts(point_prompts, i, track_id)
 
         # do we end the segmentation at the outer slices?
+        # (We don't need to reset the segmentation for stop slices, it is zero-initialized.)
         if points_i is None:
 
             if i == slices[0]:  # The bottom slice is a stop slice.
                 stop_lower = True
-                seg[i] = 0
             elif i == slices[-1]:  # The top sloce is a stop slice.
                 stop_upper = True
-                seg[i] = 0
             else:  # We have a stop annotation somewhere in the middle. Ignore this.
                 # Remove this slice from the annotated slices, so that it is segmented via
                 # projection in the next step.
@@ -404,7 +429,7 @@ def segment_slices_with_prompts(
 
         seg_i = prompt_segmentation(
             predictor, points, labels, boxes, masks, image_shape, multiple_box_prompts=False,
-            image_embeddings=image_embeddings, i=i
+            image_embeddings=image_embeddings, i=i, out=seg[i],
         )
         if seg_i is None:
             print(f"The prompts at slice or frame {i} are invalid and the segmentation was skipped.")
@@ -412,7 +437,6 @@ def segment_slices_with_prompts(
             print(f"Please correct the prompts in {i} and rerun the segmentation.")
             continue
 
-        seg[i] = seg_i
         update_progress(1)
 
     return seg, slices, stop_lower, stop_upper
@@ -463,8 +487,9 @@ def _batched_interactive_segmentation(predictor, points, labels, boxes, image_em
     # else:
     #     batched_prompts = _match_prompts(prev_seg, batched_points, boxes, seg_ids)
 
-    for seg_id, prompt in batched_prompts.items():
-        box, point, label = prompt
+    # Paint the predictions in bounded batches, so that we don't keep the predictions for all objects in memory.
+    predictions, seg_ids = [], []
+    for seg_id, (box, point, label) in batched_prompts.items():
         if len(negative_points) > 0:
             if point is None:
                 point, label = negative_points, negative_labels
@@ -484,18 +509,24 @@ def _batched_interactive_segmentation(predictor, points, labels, boxes, image_em
             prediction = prompt_based_segmentation.segment_from_points(
                 predictor, point, label, image_embeddings=image_embeddings, i=i
             ).squeeze()
+        predictions.append(prediction)
+        seg_ids.append(seg_id)
+        if len(predictions) == _PAINT_BATCH_SIZE:
+            _kernels.paint_masks(seg, predictions, seg_ids)
+            predictions, seg_ids = [], []
 
-        seg[prediction] = seg_id
-
+    _kernels.paint_masks(seg, predictions, seg_ids)
     return seg
 
 
 def prompt_segmentation(
     predictor, points, labels, boxes, masks, shape, multiple_box_prompts,
     image_embeddings=None, i=None, box_extension=0, batched=None,
-    previous_segmentation=None,
+    previous_segmentation=None, out=None,
 ):
     """@private"""
+    # If 'out' is given the segmentation is written to it, e.g. to a slice of a label layer,
+    # and it is returned instead of a new array. It is not changed if the prompts are invalid.
     assert len(points) == len(labels)
     have_points = len(points) > 0
     have_boxes = len(boxes) > 0
@@ -536,14 +567,21 @@ def prompt_segmentation(
 
     # Only box prompts were given.
     elif not have_points and have_boxes:
-        seg = np.zeros(shape, dtype="uint32")
-
         if len(boxes) > 1 and not multiple_box_prompts:
             print("You have provided more than one box annotation. This is not yet supported in the 3d annotator.")
             print("You can only segment one object at a time in 3d.")
             return
 
+        # Write the predictions directly to the output, if it is given.
+        if out is None:
+            seg = np.zeros(shape, dtype="uint32")
+        else:
+            seg = out
+            seg.fill(0)
+
         # Batch this?
+        # Paint the predictions in bounded batches, so that we don't keep the predictions for all boxes in memory.
+        predictions, seg_ids = [], []
         for seg_id, (box, mask) in enumerate(zip(boxes, masks), 1):
             if mask is None:
                 prediction = prompt_based_segmentation.segment_from_box(
@@ -554,8 +592,16 @@ def prompt_segmentation(
                     predictor, mask, box=box, image_embeddings=image_embeddings, i=i,
                     box_extension=box_extension,
                 ).squeeze()
-            seg[prediction] = seg_id
-
+            predictions.append(prediction)
+            seg_ids.append(seg_id)
+            if len(predictions) == _PAINT_BATCH_SIZE:
+                _kernels.paint_masks(seg, predictions, seg_ids)
+                predictions, seg_ids = [], []
+        _kernels.paint_masks(seg, predictions, seg_ids)
+
+    if out is not None and seg is not out:
+        out[:] = seg
+        return out
     return seg
 
 
@@ -739,38 +785,42 @@ def _sync_ndsegment_widget(widget, model_type, checkpoint_path):
             getattr(widget, f"{param}_param").setValue(settings[param])
 
 
+class _LazyAMGState(dict):
+    """Dictionary of per-slice amg states that loads the cached states on first access.
+
+    The cached states are only listed on creation, so that we don't need to deserialize all of them.
+    """
+    def __init__(self, cache_folder):
+        super().__init__(cache_folder=cache_folder)
+        self._state_paths = {
+            int(Path(path).stem.split("-")[-1]): path for path in glob(os.path.join(cache_folder, "*.pkl"))
+        }
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self._state_paths
+
+    def __getitem__(self, key):
+        if not super().__contains__(key) and key in self._state_paths:
+            self[key] = _read_amg_state(self._state_paths[key])
+        return super().__getitem__(key)
+
+    def __len__(self):
+        return len(set(self.keys()) | set(self._state_paths))
+
+
 def _load_amg_state(embedding_path):
     if embedding_path is None or not os.path.exists(embedding_path):
         return {"cache_folder": None}
 
     cache_folder = os.path.join(embedding_path, "amg_state")
     os.makedirs(cache_folder, exist_ok=True)
-    amg_state = {"cache_folder": cache_folder}
-
-    state_paths = glob(os.path.join(cache_folder, "*.pkl"))
-    for path in state_paths:
-        with open(path, "rb") as f:
-            state = pickle.load(f)
-        i = int(Path(path).stem.split("-")[-1])
-        amg_state[i] = state
-    return amg_state
+    return _LazyAMGState(cache_folder)
 
 
 def _load_is_state(embedding_path):
     if embedding_path is None or not os.path.exists(embedding_path):
         return {"cache_path": None}
 
-    cache_path = os.path.join(embedding_path, "is_state.h5")
-    is_state = {"cache_path": cache_path}
-
-    with h5py.File(cache_path, "a") as f:
-        for name, g in f.items():
-            i = int(name.split("-")[-1])
-            state = {
-                "foreground": g["foreground"][:],
-                "boundary_distances": g["boundary_distances"][:],
-                "center_distances": g["center_distances"][:],
-            }
-            is_state[i] = state
-
+    is_state = {"cache_path": embedding_path}
+    is_state.update(_read_all_is_states(_get_is_state_cache(embedding_path)))
     return is_state
@@ -153,8 +153,9 @@ class ConvertToSamInputs:
 
         _, bbox_coordinates = get_centers_and_bounding_boxes(gt, mode="p")
 
-        # get the segment ids
-        cell_ids = np.unique(gt)[1:]
+        # get the segment ids, the bounding boxes are computed for all objects in the order of their ids,
+        # so we can read them from there instead of computing the (sorted) unique ids of the full gt again
+        cell_ids = np.array(list(bbox_coordinates.keys()), dtype="int64")
         if n_samples is None:  # n-samples is set to None, so we use all ids
             sampled_cell_ids = cell_ids
 
@@ -7,6 +7,8 @@ import os
 import pickle
 import hashlib
 import warnings
+import multiprocessing as mp
+from concurrent import futures
 from pathlib import Path
 from collections import OrderedDict
 from typing import Any, Dict, Iterable, Optional, Tuple, Union
@@ -486,6 +488,18 @@ def _to_image(input_):
     return image
 
 
+def _prefetch(load_input, n_inputs):
+    # Load the inputs for the embedding computation in a background thread.
+    # This overlaps reading and preprocessing of the next input with the model prediction for the current one.
+    with futures.ThreadPoolExecutor(1) as tp:
+        future = tp.submit(load_input, 0) if n_inputs > 0 else None
+        for i in range(n_inputs):
+            input_ = future.result()
+            if i + 1 < n_inputs:
+                future = tp.submit(load_input, i + 1)
+            yield input_
+
+
 def _compute_tiled_features_2d(predictor, input_, tile_shape, halo, f, pbar_init, pbar_update):
     tiling = blocking([0, 0], input_.shape[:2], tile_shape)
     n_tiles = tiling.numberOfBlocks
@@ -495,13 +509,14 @@ def _compute_tiled_features_2d(predictor, input_, tile_shape, halo, f, pbar_init
     features.attrs["tile_shape"] = tile_shape
     features.attrs["halo"] = halo
 
-    pbar_init(n_tiles, "Compute Image Embeddings 2D tiled.")
-    for tile_id in range(n_tiles):
+    def load_tile(tile_id):
         tile = tiling.getBlockWithHalo(tile_id, list(halo))
         outer_tile = tuple(slice(beg, end) for beg, end in zip(tile.outerBlock.begin, tile.outerBlock.end))
+        return _to_image(input_[outer_tile])
 
+    pbar_init(n_tiles, "Compute Image Embeddings 2D tiled.")
+    for tile_id, tile_input in enumerate(_prefetch(load_tile, n_tiles)):
         predictor.reset_image()
-        tile_input = _to_image(input_[outer_tile])
         predictor.set_image(tile_input)
         tile_features = predictor.get_image_embedding()
         original_size = predictor.original_size
@@ -540,9 +555,10 @@ def _compute_tiled_features_3d(predictor, input_, tile_shape, halo, f, pbar_init
         outer_tile = tuple(slice(beg, end) for beg, end in zip(tile.outerBlock.begin, tile.outerBlock.end))
 
         ds = None
-        for z in range(n_slices):
+        # Bind the current tile explicitly, so that the prefetch does not depend on the loop variable.
+        tile_inputs = _prefetch(lambda z, outer_tile=outer_tile: _to_image(input_[z][outer_tile]), n_slices)
+        for z, tile_input in enumerate(tile_inputs):
             predictor.reset_image()
-            tile_input = _to_image(input_[z][outer_tile])
             predictor.set_image(tile_input)
             tile_features = predictor.get_image_embedding()
 
@@ -623,11 +639,25 @@ def _compute_tiled_2d(input_, predictor, tile_shape, halo, f, pbar_init, pbar_up
     return image_embeddings
 
 
+def _load_features(ds):
+    # Load the cached features for all slices in parallel.
+    # zarr decompresses the chunks one after the other when reading the full dataset,
+    # but the decompression releases the GIL, so we can read the slices with threads instead.
+    features = np.empty(ds.shape, dtype=ds.dtype)
+
+    def load_slice(z):
+        features[z] = ds[z]
+
+    with futures.ThreadPoolExecutor(mp.cpu_count()) as tp:
+        list(tp.map(load_slice, range(ds.shape[0])))
+    return features
+
+
 def _compute_3d(input_, predictor, f, save_path, lazy_loading, pbar_init, pbar_update):
     # Check if the embeddings are already fully cached.
     if save_path is not None and "input_size" in f.attrs:
         # In this case we load the embeddings.
-        features = f["features"] if lazy_loading else f["features"][:]
+        features = f["features"] if lazy_loading else _load_features(f["features"])
         original_size, input_size = f.attrs["original_size"], f.attrs["input_size"]
         image_embeddings = {
             "features": features, "input_size": input_size, "original_size": original_size,
@@ -659,13 +689,12 @@ def _compute_3d(input_, predictor, f, save_path, lazy_loading, pbar_init, pbar_u
     pbar_init(input_.shape[0], "Compute Image Embeddings 3D")
 
     # Compute the embeddings for each slice.
-    for z, z_slice in enumerate(input_):
-        # Skip feature computation in case of partial features in non-zero slice.
-        if partial_features and np.count_nonzero(features[z]) != 0:
-            continue
-
+    # Skip feature computation in case of partial features in non-zero slice.
+    z_indices = [z for z in range(input_.shape[0]) if not (partial_features and np.count_nonzero(features[z]) != 0)]
+    z_slices = _prefetch(lambda i: _to_image(input_[z_indices[i]]), len(z_indices))
+    for z, z_slice in zip(z_indices, z_slices):
         predictor.reset_image()
-        predictor.set_image(_to_image(z_slice))
+        predictor.set_image(z_slice)
         embedding = predictor.get_image_embedding()
         original_size, input_size = predictor.original_size, predictor.input_size
 
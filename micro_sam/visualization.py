@@ -1,6 +1,8 @@
 """
 Functionality for visualizing image embeddings.
 """
+import multiprocessing as mp
+from concurrent import futures
 from typing import Tuple
 
 import numpy as np
@@ -29,11 +31,18 @@ def compute_pca(embeddings: np.ndarray) -> np.ndarray:
     if embeddings.ndim == 4:
         pca = embedding_pca(embeddings.squeeze()).transpose((1, 2, 0))
     elif embeddings.ndim == 5:
-        pca = []
-        for embed in embeddings:
-            vis = embedding_pca(embed.squeeze()).transpose((1, 2, 0))
-            pca.append(vis)
-        pca = np.stack(pca)
+        # Compute the pca for the slices in parallel and write it to a pre-allocated output.
+        # (The linear algebra in the pca releases the GIL, so we can use threads here.)
+        pca = None
+
+        def compute_slice(z):
+            return embedding_pca(embeddings[z].squeeze()).transpose((1, 2, 0))
+
+        with futures.ThreadPoolExecutor(min(mp.cpu_count(), len(embeddings))) as tp:
+            for z, vis in enumerate(tp.map(compute_slice, range(len(embeddings)))):
+                if pca is None:
+                    pca = np.empty((len(embeddings),) + vis.shape, dtype=vis.dtype)
+                pca[z] = vis
     else:
         raise ValueError(f"Expect input of ndim 4 or 5, got {embeddings.ndim}")
     return pca
@@ -0,0 +1,148 @@
+import unittest
+
+import numpy as np
+
+
+class TestKernels(unittest.TestCase):
+    def _get_labels(self, shape=(16, 64, 64), max_id=8, seed=0):
+        rng = np.random.default_rng(seed)
+        labels = rng.integers(0, max_id, size=shape).astype("uint32")
+        labels[rng.random(shape) < 0.5] = 0
+        return labels
+
+    def test_label_max(self):
+        from micro_sam._kernels import label_max
+
+        labels = self._get_labels()
+        self.assertEqual(label_max(labels), int(labels.max()))
+        self.assertEqual(label_max(np.zeros(0, dtype="uint32")), 0)
+        # Non-contiguous arrays use the numpy fallback.
+        self.assertEqual(label_max(labels[:, ::2]), int(labels[:, ::2].max()))
+
+    def test_label_max_zarr(self):
+        import zarr
+        from micro_sam._kernels import label_max
+
+        labels = self._get_labels()
+        ds = zarr.zeros(labels.shape, chunks=(4, 32, 32), dtype=labels.dtype)
+        ds[:] = labels
+        self.assertEqual(label_max(ds), int(labels.max()))
+        self.assertEqual(label_max(ds, block_shape=(8, 16, 16)), int(labels.max()))
+
+    def test_add_offset_nonzero(self):
+        from micro_sam._kernels import add_offset_nonzero
+
+        labels = self._get_labels()
+        expected = labels.copy()
+        expected[expected != 0] += 7
+        self.assertEqual(add_offset_nonzero(labels, 7), int(expected.max()))
+        np.testing.assert_array_equal(labels, expected)
+
+        labels = np.zeros((4, 4), dtype="uint32")
+        self.assertEqual(add_offset_nonzero(labels, 7), 0)
+        self.assertEqual(labels.sum(), 0)
+
+    def _test_commit_labels(self, preserve_committed):
+        from micro_sam._kernels import commit_labels
+
+        seg = self._get_labels(seed=0)
+        committed = self._get_labels(seed=1)
+        id_offset = int(committed.max())
+
+        # Compute the expected result with numpy.
+        expected_seg, expected_committed = seg.copy(), committed.copy()
+        expected_mask = expected_seg != 0
+        if preserve_committed:
+            expected_mask[expected_committed != 0] = 0
+        expected_seg[expected_mask] += id_offset
+        expected_committed[expected_mask] = expected_seg[expected_mask]
+
+        mask = commit_labels(seg, committed, id_offset, preserve_committed)
+        np.testing.assert_array_equal(mask, expected_mask)
+        np.testing.assert_array_equal(seg, expected_seg)
+        np.testing.assert_array_equal(committed, expected_committed)
+
+    def test_commit_labels(self):
+        self._test_commit_labels(preserve_committed=False)
+
+    def test_commit_labels_preserve_committed(self):
+        self._test_commit_labels(preserve_committed=True)
+
+    def test_unique_labels(self):
+        from micro_sam._kernels import unique_labels
+
+        labels = self._get_labels()
+        np.testing.assert_array_equal(unique_labels(labels), np.unique(labels))
+        # Large ids in a small range, like after adding an id offset.
+        offset_labels = labels.astype("uint64") + 2**40
+        np.testing.assert_array_equal(unique_labels(offset_labels), np.unique(offset_labels))
+        # Ids spanning a large range, which fall back to np.unique.
+        labels[0, 0, 0] = 2**30
+        np.testing.assert_array_equal(unique_labels(labels), np.unique(labels))
+        self.assertEqual(len(unique_labels(np.zeros(0, dtype="uint32"))), 0)
+
+        labels = self._get_labels()
+        ids, counts = unique_labels(labels, return_counts=True)
+        expected_ids, expected_counts = np.unique(labels, return_counts=True)
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_array_equal(counts, expected_counts)
+
+    def test_replace_object(self):
+        from micro_sam._kernels import replace_object
+
+        labels = self._get_labels()
+        seg = self._get_labels(seed=1) == 1
+        expected = labels.copy()
+        expected[expected == 3] = 0
+        expected[seg == 1] = 3
+
+        replace_object(labels, seg, 3)
+        np.testing.assert_array_equal(labels, expected)
+
+    def test_paint_masks(self):
+        from micro_sam._kernels import paint_masks
+
+        rng = np.random.default_rng(0)
+        shape = (64, 64)
+        masks = [rng.random(shape) < 0.1 for _ in range(100)]
+        # Also check small, overlapping and empty masks, which are only painted within their bounding box.
+        for _ in range(50):
+            mask = np.zeros(shape, dtype="bool")
+            y, x = rng.integers(0, 56, size=2)
+            mask[y:y + 8, x:x + 8] = rng.random((8, 8)) < 0.5
+            masks.append(mask)
+        masks.append(np.zeros(shape, dtype="bool"))
+        seg_ids = list(range(1, len(masks) + 1))
+        expected = np.zeros(shape, dtype="uint32")
+        for mask, seg_id in zip(masks, seg_ids):
+            expected[mask] = seg_id
+
+        labels = np.zeros(shape, dtype="uint32")
+        paint_masks(labels, masks, seg_ids)
+        np.testing.assert_array_equal(labels, expected)
+
+    def test_serial(self):
+        from concurrent import futures
+        from micro_sam import _kernels
+
+        rng = np.random.default_rng(0)
+        labels = [rng.integers(0, 100, size=(64, 64)).astype("uint32") for _ in range(8)]
+        expected = [_kernels.unique_labels(lab, return_counts=True) for lab in labels]
+
+        def compute(lab):
+            with _kernels.serial():
+                self.assertFalse(_kernels._use_numba(lab))
+                return _kernels.unique_labels(lab, return_counts=True)
+
+        with futures.ThreadPoolExecutor(4) as tp:
+            results = list(tp.map(compute, labels))
+        for (ids, counts), (expected_ids, expected_counts) in zip(results, expected):
+            np.testing.assert_array_equal(ids, expected_ids)
+            np.testing.assert_array_equal(counts, expected_counts)
+
+        # The serial mode only applies within the context.
+        self.assertEqual(_kernels._use_numba(labels[0]), _kernels.HAVE_NUMBA)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import unittest
+from shutil import rmtree
+
+import numpy as np
+
+
+class TestPrecomputeState(unittest.TestCase):
+    tmp_folder = "tmp-files"
+
+    def setUp(self):
+        os.makedirs(self.tmp_folder, exist_ok=True)
+
+    def tearDown(self):
+        rmtree(self.tmp_folder)
+
+    def _get_state(self, seed, shape=(32, 32)):
+        rng = np.random.default_rng(seed)
+        return {
+            key: rng.random(shape).astype("float32")
+            for key in ("foreground", "boundary_distances", "center_distances")
+        }
+
+    def test_is_state_2d(self):
+        from micro_sam.precompute_state import _get_is_state_cache, _has_is_state, _read_is_state, _write_is_state
+
+        g = _get_is_state_cache(os.path.join(self.tmp_folder, "embeddings.zarr"))
+        self.assertFalse(_has_is_state(g))
+        self.assertIsNone(_read_is_state(g))
+
+        state = self._get_state(seed=0)
+        _write_is_state(g, state)
+        self.assertTrue(_has_is_state(g))
+        read_state = _read_is_state(g)
+        for key, val in state.items():
+            np.testing.assert_array_equal(read_state[key], val)
+
+    def test_is_state_3d(self):
+        from micro_sam.precompute_state import (
+            _get_is_state_cache, _has_is_state, _read_all_is_states, _read_is_state, _write_is_state
+        )
+
+        save_path = os.path.join(self.tmp_folder, "embeddings.zarr")
+        g = _get_is_state_cache(save_path)
+        # Write the states for a subset of the slices, in random order.
+        states = {i: self._get_state(seed=i) for i in (3, 0, 5)}
+        for i, state in states.items():
+            _write_is_state(g, state, i=i)
+
+        # Re-open the cache to check the state on disk.
+        g = _get_is_state_cache(save_path)
+        for i in range(8):
+            self.assertEqual(_has_is_state(g, i=i), i in states)
+            read_state = _read_is_state(g, i=i)
+            if i not in states:
+                self.assertIsNone(read_state)
+                continue
+            for key, val in states[i].items():
+                np.testing.assert_array_equal(read_state[key], val)
+
+        all_states = _read_all_is_states(g)
+        self.assertEqual(sorted(all_states.keys()), sorted(states.keys()))
+        for i, state in states.items():
+            for key, val in state.items():
+                np.testing.assert_array_equal(all_states[i][key], val)
+
+    def test_is_state_3d_written_slices(self):
+        from micro_sam.precompute_state import _get_is_state_cache, _has_is_state, _read_is_state, _write_is_state
+
+        # The written slices are tracked explicitly, so states that contain nan or integer values are supported.
+        g = _get_is_state_cache(os.path.join(self.tmp_folder, "embeddings.zarr"))
+        state = {key: np.full((16, 16), np.nan, dtype="float32") for key in ("foreground", "boundary_distances")}
+        state["center_distances"] = np.zeros((16, 16), dtype="int64")
+        _write_is_state(g, state, i=1)
+        self.assertFalse(_has_is_state(g, i=0))
+        self.assertTrue(_has_is_state(g, i=1))
+        read_state = _read_is_state(g, i=1)
+        for key, val in state.items():
+            np.testing.assert_array_equal(read_state[key], val)
+
+    def _write_legacy_is_state(self, save_path, states):
+        import h5py
+
+        os.makedirs(save_path, exist_ok=True)
+        with h5py.File(os.path.join(save_path, "is_state.h5"), "a") as f:
+            for name, state in states.items():
+                g = f.create_group(name)
+                for key, val in state.items():
+                    g.create_dataset(key, data=val, compression="gzip")
+
+    def test_legacy_is_state_2d(self):
+        from micro_sam.precompute_state import _get_is_state_cache, _read_is_state
+
+        save_path = os.path.join(self.tmp_folder, "embeddings.zarr")
+        state = self._get_state(seed=0)
+        self._write_legacy_is_state(save_path, {"state": state})
+
+        read_state = _read_is_state(_get_is_state_cache(save_path))
+        for key, val in state.items():
+            np.testing.assert_array_equal(read_state[key], val)
+        self.assertFalse(os.path.exists(os.path.join(save_path, "is_state.h5")))
+
+    def test_legacy_is_state_3d(self):
+        from micro_sam.precompute_state import _get_is_state_cache, _read_all_is_states
+
+        save_path = os.path.join(self.tmp_folder, "embeddings.zarr")
+        states = {i: self._get_state(seed=i) for i in (0, 2, 11)}
+        self._write_legacy_is_state(save_path, {f"state-{i}": state for i, state in states.items()})
+
+        all_states = _read_all_is_states(_get_is_state_cache(save_path))
+        self.assertEqual(sorted(all_states.keys()), sorted(states.keys()))
+        for i, state in states.items():
+            for key, val in state.items():
+                np.testing.assert_array_equal(all_states[i][key], val)
+        self.assertFalse(os.path.exists(os.path.join(save_path, "is_state.h5")))
+
+
+if __name__ == "__main__":
+    unittest.main()
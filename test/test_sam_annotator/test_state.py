@@ -27,6 +27,27 @@ class TestState(unittest.TestCase):
         state.widgets = {"tracking": Container()}
         self.assertTrue(state.initialized_for_tracking())
 
+    def test_write_to_cache(self):
+        from micro_sam.sam_annotator._state import AnnotatorState
+
+        written = []
+
+        def write(i):
+            if i == 3:
+                raise OSError("Disk is full.")
+            written.append(i)
+
+        state = AnnotatorState()
+        for i in range(20):
+            state.write_to_cache(write, i)
+        self.assertLessEqual(state.cache_queue.qsize(), state.cache_queue.maxsize)
+
+        # The failed write is reported after all pending writes are finished, and only once.
+        with self.assertRaises(RuntimeError):
+            state.wait_for_cache()
+        self.assertEqual(written, [i for i in range(20) if i != 3])
+        state.wait_for_cache()
+
 
 if __name__ == "__main__":
     unittest.main()
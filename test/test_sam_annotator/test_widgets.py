@@ -65,3 +65,115 @@ def test_embedding_widget(make_napari_viewer, tmp_path):
 
     # Close the viewer at the end of the test.
     viewer.close()
+
+
+def _test_commit_to_file(tmp_path, shape, chunks):
+    import z5py
+    from micro_sam._kernels import commit_labels
+    from micro_sam.sam_annotator._widgets import _write_committed_segmentation
+
+    rng = np.random.default_rng(0)
+    committed = np.zeros(shape, dtype="uint32")
+    f = z5py.ZarrFile(os.path.join(tmp_path, "commit.zarr"), "a")
+
+    # Commit objects in the full volume, then in a sub-volume, then overwrite the full volume.
+    # The last commit fully covers all chunks, so that they are written directly.
+    full_bb = tuple(slice(0, sh) for sh in shape)
+    sub_bb = tuple(slice(sh // 4, 3 * sh // 4) for sh in shape)
+    commits = [(full_bb, 0.2, True), (sub_bb, 0.5, True), (full_bb, 1.0, False)]
+    for bb, fraction, preserve_committed in commits:
+        this_shape = committed[bb].shape
+        seg = rng.integers(1, 5, size=this_shape).astype("uint32")
+        seg[rng.random(this_shape) > fraction] = 0
+        id_offset = int(committed.max())
+        # This updates the committed objects in-place, because committed[bb] is a view.
+        mask = commit_labels(seg, committed[bb], id_offset, preserve_committed)
+        _write_committed_segmentation(f, shape, chunks, seg, mask, bb, id_offset)
+        np.testing.assert_array_equal(f["committed_objects"][:], committed)
+
+
+def test_commit_to_file(tmp_path):
+    _test_commit_to_file(tmp_path, shape=(8, 32, 32), chunks=(4, 16, 16))
+
+
+def test_commit_to_file_with_border_chunks(tmp_path):
+    # The shape is not a multiple of the chunks, so that the chunks at the border are clipped.
+    _test_commit_to_file(tmp_path, shape=(10, 37, 45), chunks=(4, 16, 16))
+
+
+def _check_prompts(read_prompts, expected_prompts):
+    assert sorted(read_prompts.keys()) == sorted(expected_prompts.keys())
+    for object_id, (prompts, point_prompts) in expected_prompts.items():
+        for read, expected in zip(read_prompts[object_id], (prompts, point_prompts)):
+            if expected is None:
+                assert read is None
+            else:
+                np.testing.assert_array_equal(read, expected)
+
+
+def test_write_and_read_prompts(tmp_path):
+    from micro_sam.sam_annotator._widgets import _read_prompts, _write_prompts
+
+    f = zarr.open_group(os.path.join(tmp_path, "commit.zarr"), mode="a")
+    assert _read_prompts(f) == {}
+
+    box = np.array([[0, 0], [0, 10], [10, 10], [10, 0]], dtype="float64")
+    points = np.array([[5, 5], [3, 4]], dtype="float64")
+    # A single object with box and point prompts, then two objects with box prompts.
+    _write_prompts(f, [1], [[box]], [points])
+    _write_prompts(f, [2, 3], [[box + 1], [box + 2]], None)
+    # Objects may also not have any prompts.
+    _write_prompts(f, [4], None, None)
+
+    expected_prompts = {
+        1: (box[None], points), 2: ((box + 1)[None], None), 3: ((box + 2)[None], None), 4: (None, None),
+    }
+    _check_prompts(_read_prompts(f), expected_prompts)
+
+
+def test_write_prompts_legacy_layout(tmp_path):
+    from micro_sam.sam_annotator._widgets import _read_prompts, _write_prompts
+
+    # Write prompts in the previous layout, with one group per object.
+    f = zarr.open_group(os.path.join(tmp_path, "commit.zarr"), mode="a")
+    box = np.array([[0, 0], [0, 10], [10, 10], [10, 0]], dtype="float64")
+    points = np.array([[5, 5], [3, 4]], dtype="float64")
+    f.create_group("prompts/1").create_dataset("point_prompts", data=points)
+    f.create_group("prompts/2").create_dataset("prompts", data=box[None])
+
+    expected_prompts = {1: (None, points), 2: (box[None], None)}
+    _check_prompts(_read_prompts(f), expected_prompts)
+
+    # Writing new prompts converts the file to the new layout.
+    _write_prompts(f, [3], [[box + 1]], None)
+    assert "1" not in f["prompts"] and "2" not in f["prompts"]
+    expected_prompts[3] = ((box + 1)[None], None)
+    _check_prompts(_read_prompts(f), expected_prompts)
+
+
+@pytest.mark.parametrize("object_id", [1, 3])
+def test_update_label_object(object_id):
+    from napari.layers import Labels
+    from micro_sam.sam_annotator.util import _update_label_object
+
+    rng = np.random.default_rng(0)
+    data = np.zeros((3, 64, 64), dtype="uint32")
+    data[1, 10:20, 10:20] = object_id
+    data[1, 40:50, 40:50] = object_id + 1
+    layer = Labels(data.copy())
+
+    for seg_bb in (np.s_[15:30, 5:25], np.s_[50:60, 50:60]):
+        seg = np.zeros((64, 64), dtype="bool")
+        seg[seg_bb] = rng.random(seg[seg_bb].shape) < 0.7
+
+        expected = data.copy()
+        expected[1][expected[1] == object_id] = 0
+        expected[1][seg] = object_id
+        _update_label_object(layer, 1, seg, object_id)
+        np.testing.assert_array_equal(layer.data, expected)
+        data = expected
+
+    # Clearing the object.
+    _update_label_object(layer, 1, np.zeros((64, 64), dtype="bool"), object_id)
+    assert object_id not in layer.data
+    assert (layer.data[1, 40:50, 40:50] == object_id + 1).all()